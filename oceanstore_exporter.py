@@ -4,37 +4,65 @@ Exporter for Huawei Ocean Dorado Storage
 """
 
 import argparse
+import http.client
+import json
 import logging
+import os
+import re
+import signal
+import socket
 import sys
+import threading
 import time
+import zlib
+from collections import deque
 from configparser import ConfigParser
-from pprint import pprint as pp
-import requests
-from requests.exceptions import HTTPError
-from requests.packages.urllib3.exceptions import InsecureRequestWarning
-requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+from types import MappingProxyType
+from urllib.parse import parse_qs, urlencode, urlparse
+# requests, concurrent.futures, http.server and multiprocessing are imported where
+# they are used, an exec run with transport = http.client does not load them
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
 __VERSION__ = 0.1
 
+logger = logging.getLogger(__name__)
+
+# DeviceManager error codes for an unknown, expired or logged out session
+SESSION_EXPIRED_CODES = (-401, 1077949069)
+
 def arguments():
     parser = argparse.ArgumentParser(
         description='Huawei Dorado Storage exporter',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     )
-    # expose is not jet implemented
     parser.add_argument("-a", "--listen_addr",type=str,
                        default="127.0.0.1",
                        help="TCP address to expose metrics")
     parser.add_argument("--config", "-c", type=str,
                        help="config file")
     parser.add_argument("--target", "-t", type=str,
-                       help="Ocean Storage")
+                       help="Ocean Storage, with --http all config sections if not given")
     parser.add_argument("--timeout",type=int,
                        default=10,
-                       help="connection timeout (default 10sec")
+                       help="timeout of each REST request in seconds")
     parser.add_argument("-p", "--listen_port",type=int,
                        default=8088,
                        help="TCP port to expose metrics")
+    parser.add_argument("--http", action="store_true",
+                       help="run a resident HTTP server on listen_addr:listen_port instead of printing once")
+    parser.add_argument("--textfile", type=str,
+                       help="write <dir>/huawei_storage_<target>.prom for the node_exporter textfile collector every --interval seconds")
+    parser.add_argument("--interval", type=float,
+                       default=60,
+                       help="seconds between the collections of a target with --textfile, refresh_interval of the target if set")
+    parser.add_argument("--workers", type=int,
+                       default=0,
+                       help="with --http collect the config sections in this many worker processes")
+    parser.add_argument("--record", type=str,
+                       help="write the responses of the array to this directory for replay by tools/mock_devicemanager.py")
     parser.add_argument('--verbose', '-v',
                        required=False,
                        action='count',
@@ -73,915 +101,2226 @@ def severity(level):
     }
     return log_levels[level]
 
+class OceanStorError(Exception):
+    pass
+
+class OceanStorTimeout(OceanStorError):
+    pass
+
+class Instrumentation(object):
+    """
+    Counters and histograms about the REST requests and modules of one
+    OceanStor connection, exported with the metrics of its target.
+    """
+    BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    BUCKET_LABELS = tuple((("le", f"{bucket}"),) for bucket in BUCKETS) + ((("le", "+Inf"),),)
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, family, labels, value):
+        with self.lock:
+            histogram = self.histograms.get((family, labels))
+            if histogram is None:
+                # one count per bucket, +Inf, sum
+                histogram = self.histograms[(family, labels)] = [0] * (len(self.BUCKETS) + 2)
+            for i, bucket in enumerate(self.BUCKETS):
+                if value <= bucket:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += value
+
+    def inc(self, family, labels, value=1):
+        with self.lock:
+            self.counters[(family, labels)] = self.counters.get((family, labels), 0) + value
+
+    def set(self, family, labels, value):
+        with self.lock:
+            self.gauges[(family, labels)] = value
+
+    def export(self, metrics):
+        with self.lock:
+            for (family, labels), value in self.gauges.items():
+                metrics.add(family, value, labels)
+            for (family, labels), value in self.counters.items():
+                metrics.add(family, round(value, 6), labels)
+            for (family, labels), histogram in self.histograms.items():
+                for count, extra in zip(histogram, self.BUCKET_LABELS):
+                    metrics.add(f"{family}_bucket", count, labels, extra)
+                metrics.add(f"{family}_sum", round(histogram[-1], 6), labels)
+                metrics.add(f"{family}_count", histogram[-2], labels)
+
+class Inventory(object):
+    """
+    Cache of the objects of list endpoints keyed by TYPE:ID. A list is fetched
+    again after ttl seconds, objects missing from the new list are evicted.
+    """
+    def __init__(self, ttl) -> None:
+        self.ttl = ttl
+        self.objects = {}
+        self.fetched = {}
+        self.lock = threading.Lock()
+
+    def entries(self, connection, endpoint, fields=None):
+        if not self.ttl:
+            return connection.get_data(endpoint, fields)
+        if time.time() - self.fetched.get(endpoint, 0) < self.ttl:
+            return self.objects[endpoint].values()
+        stime = time.time()
+        objects = {}
+        for entry in connection.get_data(endpoint, fields):
+            objects["{0}:{1}".format(entry["TYPE"], entry["ID"])] = entry
+        with self.lock:
+            evicted = self.objects.get(endpoint, {}).keys() - objects.keys()
+            if evicted:
+                logger.debug(f"{endpoint} evict {len(evicted)} objects")
+            self.objects[endpoint] = objects
+            self.fetched[endpoint] = stime
+        return objects.values()
+
+    def forget(self, stats_uid):
+        # the object is gone from the array, fetch its list again on the next scrape
+        with self.lock:
+            for endpoint, objects in self.objects.items():
+                if stats_uid in objects:
+                    self.fetched[endpoint] = 0
+
+class Recorder(object):
+    """
+    Keeps the data of every successful response per endpoint and writes one
+    JSON file per endpoint, the format replayed by tools/mock_devicemanager.py.
+    Perf data is kept as {stats_uid: {data_id: value}}.
+    """
+    PERF_ENDPOINT = 'performace_statistic/cur_statistic_data'
+
+    def __init__(self, directory) -> None:
+        self.directory = directory
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    def add(self, endpoint, params, data):
+        data = data.get('data')
+        with self.lock:
+            if endpoint == self.PERF_ENDPOINT:
+                perf = self.endpoints.setdefault(endpoint, {})
+                data_ids = params['CMO_STATISTIC_DATA_ID_LIST'].split(',')
+                # not every firmware repeats the UUID in the entries
+                for stats_uid, entry in zip(params['CMO_STATISTIC_UUID'].split(','), data or []):
+                    values = entry['CMO_STATISTIC_DATA_LIST'].split(',')
+                    perf.setdefault(entry.get('CMO_STATISTIC_UUID', stats_uid), {}).update(zip(data_ids, values))
+            elif isinstance(data, list):
+                # list endpoints arrive page by page
+                self.endpoints.setdefault(endpoint, []).extend(data)
+            else:
+                self.endpoints[endpoint] = data
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with self.lock:
+            for endpoint, data in self.endpoints.items():
+                path = os.path.join(self.directory, endpoint.replace('/', '_') + '.json')
+                with open(path, 'w') as f:
+                    json.dump({'data': data}, f, indent=1)
+                logger.info(f"recorded {endpoint} to {path}")
+
+def requests_session():
+    """
+    requests.Session with TLS verification off until configure_pool(). requests is
+    imported on first use, without it the stdlib transport is used.
+    """
+    try:
+        import requests
+        from requests.packages.urllib3.exceptions import InsecureRequestWarning, ReadTimeoutError
+    except ImportError:
+        logger.warning("requests not installed, using transport http.client")
+        return HTTPClientSession()
+    requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+    session = requests.Session()
+    session.verify = False
+    session.timeout_error = (requests.exceptions.Timeout, ReadTimeoutError)
+    session.http_error = requests.exceptions.HTTPError
+    return session
+
+class HTTPClientResponse(object):
+    __slots__ = ('status_code', 'content')
+
+    def __init__(self, status_code, content) -> None:
+        self.status_code = status_code
+        self.content = content
+
+    def json(self):
+        return json_loads(self.content)
+
+class Cookies(dict):
+    def get_dict(self):
+        return dict(self)
+
+class HTTPClientSession(object):
+    """
+    Stdlib transport with the part of the requests.Session interface OceanStor
+    uses. Up to pool_size idle http.client connections are kept open and shared
+    by all threads, so keep-alive outlives the module threads of a scrape. GETs
+    are retried on connection errors and 502/503/504 with exponential backoff.
+    """
+    # socket.timeout only became an alias of TimeoutError in Python 3.10
+    timeout_error = socket.timeout
+    http_error = http.client.HTTPException
+
+    def __init__(self) -> None:
+        self.headers = {}
+        self.cookies = Cookies()
+        self.verify = False
+        self.retries = 0
+        self.retry_backoff = 0
+        self.pool_size = 1
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def configure(self, retries, retry_backoff, ca_bundle=None, pool_size=1):
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.verify = ca_bundle or False
+        self.pool_size = pool_size
+
+    def connection(self, scheme, netloc, timeout):
+        """
+        An idle connection to scheme://netloc or a new one, give it back with release().
+        """
+        with self.lock:
+            for i in range(len(self.idle) - 1, -1, -1):
+                if self.idle[i][0] == (scheme, netloc):
+                    conn = self.idle.pop(i)[1]
+                    if conn.sock is not None:
+                        conn.sock.settimeout(timeout)
+                    conn.timeout = timeout
+                    return conn
+        if scheme == 'https':
+            import ssl
+            if self.verify:
+                context = ssl.create_default_context(cafile=self.verify)
+            else:
+                context = ssl.create_default_context()
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            conn = http.client.HTTPSConnection(netloc, timeout=timeout, context=context)
+        else:
+            conn = http.client.HTTPConnection(netloc, timeout=timeout)
+        return conn
+
+    def release(self, scheme, netloc, conn):
+        with self.lock:
+            if conn.sock is not None and len(self.idle) < self.pool_size:
+                self.idle.append(((scheme, netloc), conn))
+                return
+        conn.close()
+
+    def request(self, method, url, timeout=None, params=None, **kwargs):
+        url = urlparse(url)
+        path = f"{url.path}?{urlencode(params)}" if params else url.path
+        body = None
+        headers = dict(self.headers)
+        if kwargs.get('json') is not None:
+            body = json.dumps(kwargs['json']).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        if self.cookies:
+            headers['Cookie'] = "; ".join(f"{name}={value}" for name, value in self.cookies.items())
+        attempt = 0
+        while True:
+            conn = self.connection(url.scheme, url.netloc, timeout)
+            reused = conn.sock is not None
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                content = response.read()
+            except self.timeout_error:
+                conn.close()
+                raise
+            except (OSError, self.http_error):
+                conn.close()
+                # the array closes idle keep-alive connections, retry those once right away
+                if reused or (method == 'GET' and attempt < self.retries):
+                    attempt += 0 if reused else 1
+                    self.backoff(0 if reused else attempt)
+                    continue
+                raise
+            self.release(url.scheme, url.netloc, conn)
+            if response.status in (502, 503, 504) and method == 'GET' and attempt < self.retries:
+                attempt += 1
+                self.backoff(attempt)
+                continue
+            for name, value in response.getheaders():
+                if name.lower() == 'set-cookie':
+                    cookie, _, _ = value.partition(';')
+                    key, _, cookie_value = cookie.partition('=')
+                    self.cookies[key.strip()] = cookie_value.strip()
+            return HTTPClientResponse(response.status, content)
+
+    def backoff(self, attempt):
+        if attempt > 1:
+            time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
 class OceanStor(object):
-    def __init__(self, host, port, username, password, timeout) -> None:
+    def __init__(self, host, port, username, password, timeout, perf_batch_size=100, page_size=100, inventory_ttl=0, perf_plans=None, filters=None, scheme='https', objects=None, transport='requests') -> None:
         self.host = host
         self.port = port
         self.username = username
         self.password = password
         self.timeout = timeout
-        self.url = f"https://{self.host}:{self.port}/deviceManager/rest"
-        self.session = requests.Session()
-        self.session.verify = False
+        self.perf_batch_size = perf_batch_size
+        self.page_size = page_size
+        self.inventory = Inventory(inventory_ttl)
+        self.perf_plans = perf_plans or PERF_PLANS
+        self.filters = filters or {}
+        self.objects = objects or OBJECT_SPECS
+        self.stats = Instrumentation()
+        # deadline of the module running in the current thread
+        self.local = threading.local()
+        self.url = f"{scheme}://{self.host}:{self.port}/deviceManager/rest"
+        self.session = HTTPClientSession() if transport == 'http.client' else requests_session()
+        self.deviceID = None
+        self.new_session = False
+        self.lock = threading.Lock()
+        self.recorder = None
+
+    def configure_pool(self, pool_size, retries, retry_backoff, ca_bundle=None):
+        """
+        Keep up to pool_size connections to the array open for reuse, so concurrent
+        modules do not pay a TLS handshake per request. Idempotent GETs are retried
+        with exponential backoff on connection errors and 502/503/504, not on read
+        timeouts, which would restart the module deadline. With ca_bundle the array
+        certificate is verified.
+        """
+        if isinstance(self.session, HTTPClientSession):
+            self.session.configure(retries, retry_backoff, ca_bundle, pool_size)
+            return
+        from requests.adapters import HTTPAdapter
+        from requests.packages.urllib3.util.retry import Retry
+        retry = Retry(total=retries, connect=retries, read=False, status=retries, other=0,
+                      backoff_factor=retry_backoff, allowed_methods=frozenset(['GET']),
+                      status_forcelist=(502, 503, 504), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry, pool_block=False)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.verify = ca_bundle or False
 
     def login(self):
         logger.debug(f"start login")
+        labels = (("endpoint", "sessions"),)
+        stime = time.monotonic()
+        self.stats.inc("huawei_storage_exporter_requests_total", labels)
         try:
-            response = self.session.post(self.url + '/xxxxx/sessions',json={'scope': 0,'username': self.username,'password': self.password})
-        except HTTPError as HttpErr:
-            logger.error(f"login {HttpErr}")
+            response = self.session.post(self.url + '/xxxxx/sessions',json={'scope': 0,'username': self.username,'password': self.password}, timeout=self.remaining())
+            resp = response.json()
+        except OceanStorTimeout:
+            raise
         except Exception as err:
-            logger.critical(f"login {err}")
-        resp = response.json()
+            raise self.request_error("login", labels, err)
+        self.stats.observe("huawei_storage_exporter_request_duration_seconds", labels, time.monotonic() - stime)
         logger.debug(f"{resp}")
         if resp['error']['code'] != 0:
+            self.stats.inc("huawei_storage_exporter_request_errors_total", labels + (("code", f"{resp['error']['code']}"),))
             logger.error(f"login {resp['error']['description']} {resp['error']['suggestion']}")
-            sys.exit(3)
+            raise OceanStorError(f"login {resp['error']['description']}")
         elif not 'deviceid' in resp['data']:
             logger.critical(f"login no deviceID found -> exit")
-            sys.exit(3)
+            raise OceanStorError("login no deviceID found")
         else:
             self.deviceID = resp['data']['deviceid']
             self.session.headers.update({'iBaseToken': resp['data']['iBaseToken'], 'Content-Type': 'application/json', 'Accept': 'application/json'})
+            self.new_session = True
         return True
 
-    def get_data(self,endpoint):
+    def request_error(self, name, labels, err):
+        """
+        Log and count a failed request, return the OceanStorError to raise.
+        """
+        # requests reports a timeout of the last retry as ConnectionError(MaxRetryError(reason))
+        reason = getattr(err.args[0], 'reason', None) if err.args else None
+        if isinstance(err, self.session.timeout_error) or isinstance(reason, self.session.timeout_error):
+            logger.error(f"{name} {err}")
+            code, error = "timeout", OceanStorTimeout
+        elif isinstance(err, self.session.http_error):
+            logger.error(f"{name} {err}")
+            code, error = "http", OceanStorError
+        else:
+            logger.critical(f"{name} {err}")
+            code, error = "connection", OceanStorError
+        self.stats.inc("huawei_storage_exporter_request_errors_total", labels + (("code", code),))
+        return error(f"{name} {err}")
+
+    def relogin(self, token):
+        # several modules may see the expired token at the same time, only the first one logs in again
+        with self.lock:
+            if self.deviceID is None or self.session.headers.get('iBaseToken') == token:
+                self.login()
+
+    def load_session(self, path):
         try:
-            response = self.session.get(self.url + '/' + self.deviceID + '/' + endpoint )
-        except HTTPError as HttpErr:
-            logger.error(f"login {HttpErr}")
-        except Exception as err:
-            logger.critical(f"login {err}")
-        data = response.json()
-        return data
+            with open(path) as f:
+                state = json.load(f)
+            self.deviceID = state['deviceid']
+            self.session.headers.update({'iBaseToken': state['iBaseToken'], 'Content-Type': 'application/json', 'Accept': 'application/json'})
+            self.session.cookies.update(state['cookies'])
+        except (OSError, ValueError, KeyError) as err:
+            logger.debug(f"load session {path} {err}")
+            return False
+        logger.debug(f"reuse session from {path}")
+        return True
+
+    def save_session(self, path):
+        state = {
+            'deviceid': self.deviceID,
+            'iBaseToken': self.session.headers['iBaseToken'],
+            'cookies': self.session.cookies.get_dict(),
+            }
+        # the token grants access to the array, keep it private to the exporter user
+        tmp = f"{path}.{os.getpid()}"
+        try:
+            with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp, path)
+        except OSError as err:
+            logger.error(f"save session {path} {err}")
+            return False
+        self.new_session = False
+        return True
+
+    def remaining(self):
+        """
+        Timeout for the next request: the configured timeout, shortened to what
+        is left until the deadline of the current module.
+        """
+        deadline = getattr(self.local, 'deadline', None)
+        if deadline is None:
+            return self.timeout
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise OceanStorTimeout("module deadline exceeded")
+        return min(self.timeout, remaining)
+
+    def request(self, method, endpoint, **kwargs):
+        if self.deviceID is None:
+            self.relogin(None)
+        labels = (("endpoint", endpoint),)
+        for attempt in (1, 2):
+            token = self.session.headers.get('iBaseToken')
+            stime = time.monotonic()
+            self.stats.inc("huawei_storage_exporter_requests_total", labels)
+            try:
+                response = self.session.request(method, self.url + '/' + self.deviceID + '/' + endpoint, timeout=self.remaining(), **kwargs)
+                ptime = time.monotonic()
+                data = json_loads(response.content)
+            except OceanStorTimeout:
+                raise
+            except Exception as err:
+                raise self.request_error(endpoint, labels, err)
+            etime = time.monotonic()
+            self.stats.observe("huawei_storage_exporter_request_duration_seconds", labels, etime - stime)
+            self.stats.inc("huawei_storage_exporter_json_parse_seconds_total", labels, etime - ptime)
+            self.stats.inc("huawei_storage_exporter_response_bytes_total", labels, len(response.content))
+            code = int(data.get('error', {}).get('code', 0))
+            if code != 0:
+                self.stats.inc("huawei_storage_exporter_request_errors_total", labels + (("code", f"{code}"),))
+            if attempt == 1 and code in SESSION_EXPIRED_CODES:
+                logger.info(f"{endpoint} session expired, login again")
+                self.relogin(token)
+                continue
+            if self.recorder is not None and code == 0:
+                # pages are recorded as one list, the range of a page is not part of the endpoint
+                self.recorder.add(endpoint, kwargs.get('params', {}), data)
+            return data
+
+    def get_data(self,endpoint,fields=None):
+        """
+        Yield the entries of a list endpoint page by page using range=[start-end],
+        so only page_size objects are held in memory at a time. With fields only
+        these keys (case insensitive) are kept per entry.
+        """
+        wanted = {field.lower() for field in fields} if fields else None
+        start = 0
+        first_id = None
+        while True:
+            data = self.request('GET', endpoint, params={'range': f"[{start}-{start + self.page_size}]"})
+            if int(data.get('error', {}).get('code', 0)) != 0:
+                logger.error(f"{endpoint} {data['error'].get('description')}")
+                raise OceanStorError(f"{endpoint} {data['error'].get('description')}")
+            entries = data.get('data') or []
+            # endpoints without range support return the same complete list again
+            if entries and entries[0].get('ID') == first_id:
+                return
+            if wanted is None:
+                yield from entries
+            else:
+                # objects of one endpoint do not all carry the same fields
+                for entry in entries:
+                    yield {key: value for key, value in entry.items() if key.lower() in wanted}
+            if len(entries) != self.page_size:
+                return
+            first_id = entries[0].get('ID')
+            start += self.page_size
+
+    def get_inventory(self,endpoint,fields=None):
+        """
+        Entries of a list endpoint, served from the inventory cache while it is fresh.
+        With fields only these fields of the entries are kept.
+        """
+        return self.inventory.entries(self, endpoint, fields)
 
     def get_perf_data(self,stats_uid,data_ids):
         params = {"CMO_STATISTIC_UUID": stats_uid, "CMO_STATISTIC_DATA_ID_LIST": data_ids}
-        try:
-            response = self.session.get(self.url + '/' + self.deviceID + '/performace_statistic/cur_statistic_data', params=params )
-        except HTTPError as HttpErr:
-            logger.error(f"login {HttpErr}")
-        except Exception as err:
-            logger.critical(f"login {err}")
-        data = response.json()
-        return data
-    
+        return self.request('GET', 'performace_statistic/cur_statistic_data', params=params)
+
+    def get_perf_data_batch(self,stats_uids,data_ids):
+        """
+        Query the statistics of many objects with one request per perf_batch_size
+        UUIDs and return them as {stats_uid: [value, ...]} in data_ids order.
+        """
+        perf = {}
+        size = self.perf_batch_size
+        chunks = deque(stats_uids[start:start + size] for start in range(0, len(stats_uids), size))
+        while chunks:
+            chunk = chunks.popleft()
+            data = self.get_perf_data(",".join(chunk), data_ids)
+            entries = data.get('data') or []
+            code = int(data.get('error', {}).get('code', 0))
+            if code == 0 and len(entries) == len(chunk):
+                for stats_uid, entry in zip(chunk, entries):
+                    perf[entry.get('CMO_STATISTIC_UUID', stats_uid)] = entry['CMO_STATISTIC_DATA_LIST'].split(',')
+                continue
+            if len(chunk) > 1:
+                if code == 0 and len(entries) == 1:
+                    # firmware without multi UUID support answers the first UUID only
+                    logger.info(f"batched perf query not supported, fall back to single requests")
+                    self.perf_batch_size = 1
+                    chunks.extendleft([chunk])
+                    chunks = deque([stats_uid] for chunk in chunks for stats_uid in chunk)
+                else:
+                    # busy array or objects deleted meanwhile, only this chunk is queried one by one
+                    logger.info(f"batched perf query of {len(chunk)} objects failed {data.get('error')}, query them one by one")
+                    chunks.extendleft([stats_uid] for stats_uid in reversed(chunk))
+                continue
+            logger.warning(f"no perf data for {chunk[0]} {data.get('error')}")
+        return perf
+
     def logout(self):
         logger.debug(f"start logout")
+        if self.deviceID is None:
+            return False
         try:
-            resp = self.session.delete(self.url + '/' + self.deviceID + '/sessions')
-        except HTTPError as HttpErr:
+            resp = self.session.delete(self.url + '/' + self.deviceID + '/sessions', timeout=self.timeout)
+            logger.debug(f"logout {resp.json()}")
+        except self.session.http_error as HttpErr:
             logger.error(f"logout {HttpErr}")
         except Exception as err:
             logger.error(f"logout {err}")
-        logger.debug(f"logout {resp.json()}")
+        self.deviceID = None
         return True
 
+    def persist(self, session_file):
+        if session_file and self.new_session and self.deviceID is not None:
+            return self.save_session(session_file)
+        return True
+
+    def close(self, session_file=None):
+        # with a session file the session stays open for the next run
+        if not session_file:
+            return self.logout()
+        return self.persist(session_file)
+
+HEALTH_STATUS = MappingProxyType({
+    "0": "unknown",
+    "1": "normal",
+    "2": "faulty",
+    "3": "about_to_fail",
+    "5": "degraded",
+    "9": "inconsistent",
+    "11": "no input",
+    "12": "low_battery",
+    })
+
+RUNNING_STATUS = MappingProxyType({
+    "0": "unknown",
+    "1": "normal",
+    "2": "running",
+    "3": "not_running",
+    "5": "sleep_in_high_temperature",
+    "8": "spin_down",
+    "10": "link_up",
+    "11": "link_down",
+    "12": "powering_on",
+    "13": "powering_off",
+    "14": "pre-copy",
+    "16": "reconstruction",
+    "27": "online",
+    "28": "offline",
+    "32": "balancing",
+    "48": "charging",
+    "49": "charging_completed",
+    "50": "discharging",
+    "53": "initializing",
+    "103": "power_on_failed",
+    "106": "deleting",
+    })
+
+DATA_IDS = MappingProxyType({
+    "read_iops": "22",
+    "read_mbytes": "23",
+    "write_iops": "28",
+    "write_mbytes": "26",
+    "max_read_latency": "382",
+    "max_write_latency": "383",
+    "avg_read_latency": "384",
+    "avg_write_latency": "385",
+    "max_latency": "371",
+    "failed_reads": "532",
+    "failed_writes": "533",
+    "usage": "18",
+    "queue_length": "19",
+    "avg_cpu_usage": "68",
+    "avg_cache_usage": "69",
+    "read_cache_hits": "93",
+    "write_cache_hits": "95",
+    "read_cache_usage": "110",
+    "write_cache_usage": "120",
+    "cache_page_usage": "1055",
+    "cache_chunk_usage": "1056",
+    "max_read_kbytes": "802",
+    "max_write_kbytes": "803",
+    })
+
+ETH_PORT_TYPES = MappingProxyType({
+    "0": "host_port/service_port",
+    "1": "expansion_port",
+    "2": "management_port",
+    "3": "internal_port",
+    "4": "maintenance_port",
+    "5": "management/service_port",
+    "6": "maintenance/service_port",
+    "11": "cluster_port",
+    })
+
+VALUEMAP = MappingProxyType({
+    "health_status": HEALTH_STATUS,
+    "running_status": RUNNING_STATUS,
+    "data_ids": DATA_IDS,
+    "eth_port_types": ETH_PORT_TYPES,
+    })
+
 def valuemap(typ,id):
-    vmap = {
-        "health_status": {
-            "0": "unknown",
-            "1": "normal",
-            "2": "faulty",
-            "3": "about_to_fail",
-            "5": "degraded",
-            "9": "inconsistent",
-            "11": "no input",
-            "12": "low_battery"
-            },
-        "running_status": {
-            "0": "unknown",
-            "1": "normal",
-            "2": "running",
-            "3": "not_running",
-            "5": "sleep_in_high_temperature",
-            "8": "spin_down",
-            "10": "link_up",
-            "11": "link_down",
-            "12": "powering_on",
-            "13": "powering_off",
-            "14": "pre-copy",
-            "16": "reconstruction",
-            "27": "online",
-            "28": "offline",
-            "32": "balancing",
-            "48": "charging",
-            "49": "charging_completed",
-            "50": "discharging",
-            "32": "balancing",
-            "53": "initializing",
-            "103": "power_on_failed",
-            "106": "deleting",
-            }, 
-        "data_ids": {
-            "read_iops": "22",
-            "read_mbytes": "23",
-            "write_iops": "28",
-            "write_mbytes": "26",
-            "max_read_latency": "382",
-            "max_write_latency": "383",
-            "avg_read_latency": "384",
-            "avg_write_latency": "385",
-            "max_latency": "371",
-            "failed_reads": "532",
-            "failed_writes": "533",
-            "usage": "18",
-            "queue_length": "19",
-            "avg_cpu_usage": "68",
-            "avg_cache_usage": "69",
-            "read_cache_hits": "93",
-            "write_cache_hits": "95",
-            "read_cache_usage": "110",
-            "write_cache_usage": "120",
-            "cache_page_usage": "1055",
-            "cache_chunk_usage": "1056",
-            "max_read_kbytes": "802",
-            "max_write_kbytes": "803",
-            },    
-        "eth_port_types": {
-            "0": "host_port/service_port",
-            "1": "expansion_port",
-            "2": "management_port",
-            "3": "internal_port",
-            "4": "maintenance_port",
-            "5": "management/service_port",
-            "6": "maintenance/service_port",
-            "11": "cluster_port"
-            },
-        }
-    return vmap[typ][id]
-
-def get_power_data(connection):
-    data = connection.get_data("power")
-    metrics = []
-    for entry in data["data"]:
-        labels = [
-                    ("type", "PSU"),
-                    ("serial", entry["SERIALNUMBER"]),
-                    ("id", entry["ID"]),
-                    ("model", entry["MODEL"]),
-                    ("name", entry["NAME"]),
-                    ("location", entry["LOCATION"]),
-                    ]
-        metric_dict = {
-                            "key": "huawei_storage_component_health_status",
-                            "value": entry["HEALTHSTATUS"],
-                            "customlabels": [("status_text", valuemap("health_status",entry["HEALTHSTATUS"]))],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_component_running_status",
-                            "value": entry["RUNNINGSTATUS"],
-                            "customlabels": [("status_text", valuemap("running_status",entry["RUNNINGSTATUS"]))],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
+    return VALUEMAP[typ][id]
 
-    return metrics
+class PerfPlan(object):
+    """
+    Performance statistics of one object type, resolved once at startup: the
+    data ID list for the request and the metric family name of every value.
+    """
+    __slots__ = ('metrics', 'data_ids', 'families')
 
-def get_bbu_data(connection):
-    data = connection.get_data("backup_power")
-    metrics = []
-    for entry in data["data"]:
-        labels = [
-                    ("type", "bbu"),
-                    ("id", entry["ID"]),
-                    ("name", entry["NAME"]),
-                    ("location", entry["LOCATION"]),
-                    ]
-        metric_dict = {
-                            "key": "huawei_storage_component_health_status",
-                            "value": entry["HEALTHSTATUS"],
-                            "customlabels": [("status_text", valuemap("health_status",entry["HEALTHSTATUS"]))],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_component_running_status",
-                            "value": entry["RUNNINGSTATUS"],
-                            "customlabels": [("status_text", valuemap("running_status",entry["RUNNINGSTATUS"]))],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_remainlife",
-                            "value": entry["REMAINLIFEDAYS"],
-                            "customlabels": [],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-    return metrics
+    def __init__(self, metrics) -> None:
+        self.metrics = tuple(metrics)
+        self.data_ids = ",".join(DATA_IDS[metric] for metric in self.metrics)
+        self.families = tuple(f"huawei_storage_metrics_{metric}" for metric in self.metrics)
 
-def get_enclosure_data(connection):
-    data = connection.get_data("enclosure")
-    metrics = []
-    for entry in data["data"]:
-        labels = [
-                    ("type", "enclosure"),
-                    ("serial", entry["SERIALNUM"]),
-                    ("id", entry["ID"]),
-                    ("name", entry["NAME"]),
-                    ("model", entry["MODEL"]),
-                    ]
-        metric_dict = {
-                            "key": "huawei_storage_component_health_status",
-                            "value": entry["HEALTHSTATUS"],
-                            "customlabels": [("status_text", valuemap("health_status",entry["HEALTHSTATUS"]))],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_component_running_status",
-                            "value": entry["RUNNINGSTATUS"],
-                            "customlabels": [("status_text", valuemap("running_status",entry["RUNNINGSTATUS"]))],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_component_temperature",
-                            "value": entry["TEMPERATURE"],
-                            "customlabels": [],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-    return metrics
+PERF_PLANS = {
+    "disk": PerfPlan([
+        "read_iops",
+        "read_mbytes",
+        "write_iops",
+        "write_mbytes",
+        "avg_read_latency",
+        "avg_write_latency",
+        "queue_length",
+        ]),
+    "eth_port": PerfPlan([
+        "usage",
+        "queue_length",
+        "read_iops",
+        "read_mbytes",
+        "write_iops",
+        "write_mbytes",
+        "max_latency",
+        "avg_read_latency",
+        "avg_write_latency",
+        # "avg_cpu_usage",
+        # "avg_cache_usage",
+        # "read_cache_hits",
+        # "write_cache_hits",
+        # "read_cache_usage",
+        # "write_cache_usage",
+        # "cache_page_usage",
+        # "cache_chunk_usage",
+        # "max_read_kbytes",
+        # "max_write_kbytes",
+        # "failed_reads",
+        # "failed_writes",
+        ]),
+    "sas_port": PerfPlan([
+        # "usage",
+        # "queue_length",
+        "read_iops",
+        "read_mbytes",
+        "write_iops",
+        "write_mbytes",
+        "max_latency",
+        "max_read_latency",
+        "max_write_latency",
+        "avg_read_latency",
+        "avg_write_latency",
+        # "avg_cpu_usage",
+        # "avg_cache_usage",
+        # "read_cache_hits",
+        # "write_cache_hits",
+        # "read_cache_usage",
+        # "write_cache_usage",
+        # "cache_page_usage",
+        # "cache_chunk_usage",
+        # "max_read_kbytes",
+        # "max_write_kbytes",
+        # "failed_reads",
+        # "failed_writes",
+        ]),
+    "lun": PerfPlan([
+        # "usage",
+        "queue_length",
+        "read_iops",
+        "read_mbytes",
+        "write_iops",
+        "write_mbytes",
+        "max_latency",
+        # "max_read_latency",
+        # "max_write_latency",
+        "avg_read_latency",
+        "avg_write_latency",
+        # "avg_cpu_usage",
+        # "avg_cache_usage",
+        "read_cache_hits",
+        "write_cache_hits",
+        # "read_cache_usage",
+        # "write_cache_usage",
+        # "cache_page_usage",
+        # "cache_chunk_usage",
+        # "max_read_kbytes",
+        # "max_write_kbytes",
+        # "failed_reads",
+        # "failed_writes",
+        ]),
+    "disk_pool": PerfPlan([
+        # "usage",
+        "queue_length",
+        "read_iops",
+        "read_mbytes",
+        "write_iops",
+        "write_mbytes",
+        "max_latency",
+        # "max_read_latency",
+        # "max_write_latency",
+        "avg_read_latency",
+        "avg_write_latency",
+        # "avg_cpu_usage",
+        # "avg_cache_usage",
+        # "read_cache_hits",
+        # "write_cache_hits",
+        # "read_cache_usage",
+        # "write_cache_usage",
+        # "cache_page_usage",
+        # "cache_chunk_usage",
+        # "max_read_kbytes",
+        # "max_write_kbytes",
+        # "failed_reads",
+        # "failed_writes",
+        ]),
+    "storage_pool": PerfPlan([
+        # "usage",
+        "queue_length",
+        "read_iops",
+        "read_mbytes",
+        "write_iops",
+        "write_mbytes",
+        "max_latency",
+        # "max_read_latency",
+        # "max_write_latency",
+        "avg_read_latency",
+        "avg_write_latency",
+        # "avg_cpu_usage",
+        # "avg_cache_usage",
+        # "read_cache_hits",
+        # "write_cache_hits",
+        # "read_cache_usage",
+        # "write_cache_usage",
+        # "cache_page_usage",
+        # "cache_chunk_usage",
+        # "max_read_kbytes",
+        # "max_write_kbytes",
+        # "failed_reads",
+        # "failed_writes",
+        ]),
+    "controller": PerfPlan([
+        "queue_length",
+        "read_iops",
+        "read_mbytes",
+        "write_iops",
+        "write_mbytes",
+        "max_latency",
+        "avg_read_latency",
+        "avg_write_latency",
+        "avg_cpu_usage",
+        "avg_cache_usage",
+        "read_cache_hits",
+        "write_cache_hits",
+        "read_cache_usage",
+        "write_cache_usage",
+        "cache_page_usage",
+        "cache_chunk_usage",
+        "max_read_kbytes",
+        "max_write_kbytes",
+        # "failed_reads",
+        # "failed_writes",
+        # "usage"
+        ]),
+    }
 
-def get_intf_module_data(connection):
-    data = connection.get_data("intf_module")
-    metrics = []
-    for entry in data["data"]:
-        labels = [
-                    ("type", "intf_module"),
-                    ("id", entry["ID"]),
-                    ("name", entry["NAME"]),
-                    ("model", entry["MODEL"]),
-                    ("location", entry["LOCATION"])
-                    ]
-        metric_dict = {
-                            "key": "huawei_storage_component_health_status",
-                            "value": entry["HEALTHSTATUS"],
-                            "customlabels": [("status_text", valuemap("health_status",entry["HEALTHSTATUS"]))],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_component_running_status",
-                            "value": entry["RUNNINGSTATUS"],
-                            "customlabels": [("status_text", valuemap("running_status",entry["RUNNINGSTATUS"]))],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-    return metrics
+class Sample(object):
+    """
+    One sample of a metric family. labels is the tuple shared by all samples of an
+    object, extra holds sample specific labels like status_text.
+    """
+    __slots__ = ('labels', 'value', 'extra')
 
-def get_fan_data(connection):
-    data = connection.get_data("fan")
-    metrics = []
-    for entry in data["data"]:
-        labels = [
-                    ("type", "fan"),
-                    ("id", entry["ID"]),
-                    ("name", entry["NAME"]),
-                    ("location", entry["LOCATION"])
-                    ]
-        metric_dict = {
-                            "key": "huawei_storage_component_health_status",
-                            "value": entry["HEALTHSTATUS"],
-                            "customlabels": [("status_text", valuemap("health_status",entry["HEALTHSTATUS"]))],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_component_running_status",
-                            "value": entry["RUNNINGSTATUS"],
-                            "customlabels": [("status_text", valuemap("running_status",entry["RUNNINGSTATUS"]))],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-    return metrics
+    def __init__(self, labels, value, extra=()) -> None:
+        self.labels = labels
+        self.value = value
+        self.extra = extra
 
-def get_disk_data(connection):
-    data = connection.get_data("disk")
-    metrics = []
-    for entry in data["data"]:
-        labels = [
-                    ("type", "disk"),
-                    ("serial", entry["SERIALNUMBER"]),
-                    ("barcode", entry["barcode"]),
-                    ("model", entry["MODEL"]),
-                    ("location", entry["LOCATION"]),
-                    ("id", entry["ID"])
-                    ]
-        metric_dict = {
-                            "key": "huawei_storage_component_health_status",
-                            "value": entry["HEALTHSTATUS"],
-                            "customlabels": [("status_text", valuemap("health_status",entry["HEALTHSTATUS"]))],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_component_running_status",
-                            "value": entry["RUNNINGSTATUS"],
-                            "customlabels": [("status_text", valuemap("running_status",entry["RUNNINGSTATUS"]))],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_component_temperature",
-                            "value": entry["TEMPERATURE"],
-                            "customlabels": [],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_remainlife",
-                            "value": entry["REMAINLIFE"],
-                            "customlabels": [],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_usage",
-                            "value": entry["CAPACITYUSAGE"],
-                            "customlabels": [],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        stats_uid = "{0}:{1}".format(entry["TYPE"], entry["ID"])
-        perfmetrics_list = [
-                            "read_iops",
-                            "read_mbytes",
-                            "write_iops",
-                            "write_mbytes",
-                            "avg_read_latency",
-                            "avg_write_latency",
-                            "queue_length"
-                            ]
-        data_ids = []
-        for metric in perfmetrics_list:
-            data_ids.append(valuemap("data_ids",metric))
-        data = (connection.get_perf_data(stats_uid,",".join(data_ids)))
-        perf_data = data['data'][0]['CMO_STATISTIC_DATA_LIST'].split(',')
-        for metric in perfmetrics_list:
-            metric_dict = {
-                "key": f"huawei_storage_metrics_{metric}",
-                "value": f"{perf_data.pop(0)}",
-                "customlabels": [],
-                "labels": labels
-            }
-            metrics.append(metric_dict)
-    return metrics
+class Metrics(dict):
+    """
+    Samples of a module grouped by metric family name.
+    """
+    def add(self, key, value, labels, extra=()):
+        samples = self.get(key)
+        if samples is None:
+            samples = self[key] = []
+        samples.append(Sample(labels, value, extra))
 
-def get_eth_port_data(connection):
-    data = connection.get_data("eth_port")
-    metrics = []
-    for entry in data["data"]:
-        labels = [
-                    ("type", "eth_port"),
-                    ("id", entry["ID"]),
-                    ("name", entry["NAME"]),
-                    ("mac", entry["MACADDRESS"]),
-                    ("ipv4", entry["IPV4ADDR"]),
-                    ("v4mask", entry["IPV4MASK"]),
-                    ("location", entry["LOCATION"]),
-                    ("port_type_id", entry["LOGICTYPE"]),
-                    ("port_type_text", valuemap("eth_port_types",entry["LOGICTYPE"])),
-                    ]
-        metric_dict = {
-                            "key": "huawei_storage_component_health_status",
-                            "value": entry["HEALTHSTATUS"],
-                            "customlabels": [("status_text", valuemap("health_status",entry["HEALTHSTATUS"]))],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_component_running_status",
-                            "value": entry["RUNNINGSTATUS"],
-                            "customlabels": [("status_text", valuemap("running_status",entry["RUNNINGSTATUS"]))],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_port_errors",
-                            "value": entry["crcErrors"],
-                            "customlabels": [("error_type", "crc"), ("port_type", "eth")],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_port_errors",
-                            "value": entry["frameErrors"],
-                            "customlabels": [("error_type", "frame"), ("port_type", "eth")],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_port_errors",
-                            "value": entry["frameLengthErrors"],
-                            "customlabels": [("error_type", "frame_length"), ("port_type", "eth")],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        if entry["LOGICTYPE"] == "0":
-            # Here we have management and host ports. Management ports don't have metrics, so we don't query them for not "0" port type
-            stats_uid = "{0}:{1}".format(entry["TYPE"], entry["ID"])
-            perfmetrics_list = [
-                                "usage",
-                                "queue_length",
-                                "read_iops",
-                                "read_mbytes",
-                                "write_iops",
-                                "write_mbytes",
-                                "max_latency",
-                                "avg_read_latency",
-                                "avg_write_latency",
-                                # "avg_cpu_usage",
-                                # "avg_cache_usage",
-                                # "read_cache_hits",
-                                # "write_cache_hits",
-                                # "read_cache_usage",
-                                # "write_cache_usage",
-                                # "cache_page_usage",
-                                # "cache_chunk_usage",
-                                # "max_read_kbytes",
-                                # "max_write_kbytes",
-                                # "failed_reads",
-                                # "failed_writes",
-
-                                ]
-             
-            data_ids = []
-            for metric in perfmetrics_list:
-                data_ids.append(valuemap("data_ids",metric))
-            data = (connection.get_perf_data(stats_uid,",".join(data_ids)))
-            perf_data = data['data'][0]['CMO_STATISTIC_DATA_LIST'].split(',')
-            for metric in perfmetrics_list:
-                metric_dict = {
-                    "key": f"huawei_storage_metrics_{metric}",
-                    "value": f"{perf_data.pop(0)}",
-                    "customlabels": [],
-                    "labels": labels
-                }
-                metrics.append(metric_dict)
-    return metrics
+    def extend(self, other):
+        for key, samples in other.items():
+            self.setdefault(key, []).extend(samples)
 
-def get_sas_port_data(connection):
-    # I don't have them connected, so this function may contain bugs. Check out
-    data = connection.get_data("sas_port")
-    metrics = []
-    for entry in data["data"]:
-        labels = [
-                    ("type", "sas_port"),
-                    ("id", entry["ID"]),
-                    ("name", entry["NAME"]),
-                    ("location", entry["LOCATION"]),
-                    ]
-        metric_dict = {
-                            "key": "huawei_storage_component_health_status",
-                            "value": entry["HEALTHSTATUS"],
-                            "customlabels": [("status_text", valuemap("health_status",entry["HEALTHSTATUS"]))],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_component_running_status",
-                            "value": entry["RUNNINGSTATUS"],
-                            "customlabels": [("status_text", valuemap("running_status",entry["RUNNINGSTATUS"]))],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_port_errors",
-                            "value": entry["DISPARITYERROR"],
-                            "customlabels": [("error_type", "disparity"), ("port_type", "sas")],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_port_errors",
-                            "value": entry["PHYRESETERRORS"],
-                            "customlabels": [("error_type", "phy_reset"), ("port_type", "sas")],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        stats_uid = "{0}:{1}".format(entry["TYPE"], entry["ID"])
-        perfmetrics_list = [
-                            # "usage",
-                            # "queue_length",
-                            "read_iops",
-                            "read_mbytes",
-                            "write_iops",
-                            "write_mbytes",
-                            "max_latency",
-                            "max_read_latency",
-                            "max_write_latency",
-                            "avg_read_latency",
-                            "avg_write_latency",
-                            # "avg_cpu_usage",
-                            # "avg_cache_usage",
-                            # "read_cache_hits",
-                            # "write_cache_hits",
-                            # "read_cache_usage",
-                            # "write_cache_usage",
-                            # "cache_page_usage",
-                            # "cache_chunk_usage",
-                            # "max_read_kbytes",
-                            # "max_write_kbytes",
-                            # "failed_reads",
-                            # "failed_writes",
-
-                            ]
-        data_ids = []
-        for metric in perfmetrics_list:
-            data_ids.append(valuemap("data_ids",metric))
-        data = (connection.get_perf_data(stats_uid,",".join(data_ids)))
-        perf_data = data['data'][0]['CMO_STATISTIC_DATA_LIST'].split(',')
-        for metric in perfmetrics_list:
-            metric_dict = {
-                "key": f"huawei_storage_metrics_{metric}",
-                "value": f"{perf_data.pop(0)}",
-                "customlabels": [],
-                "labels": labels
-            }
-            metrics.append(metric_dict)
-    return metrics
+class ObjectFilter(object):
+    """
+    Include/exclude regular expressions on object fields and a series limit
+    for the objects of one type, applied before any perf query.
+    """
+    def __init__(self, include=(), exclude=(), max_series=0) -> None:
+        self.include = include
+        self.exclude = exclude
+        self.max_series = max_series
+        self.fields = tuple(field for field, pattern in include + exclude)
 
-def get_lun_data(connection):
-    data = connection.get_data("lun")
-    metrics = []
-    for entry in data["data"]:
-        labels = [
-                    ("type", "lun"),
-                    ("id", entry["ID"]),
-                    ("name", entry["NAME"]),
-                    ("wwn", entry["WWN"])
-                    ]
-        metric_dict = {
-                            "key": "huawei_storage_component_health_status",
-                            "value": entry["HEALTHSTATUS"],
-                            "customlabels": [("status_text", valuemap("health_status",entry["HEALTHSTATUS"]))],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_component_running_status",
-                            "value": entry["RUNNINGSTATUS"],
-                            "customlabels": [("status_text", valuemap("running_status",entry["RUNNINGSTATUS"]))],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_capacity_total",
-                            "value": entry["CAPACITY"],
-                            "customlabels": [],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_capacity_allocated",
-                            "value": entry["ALLOCCAPACITY"],
-                            "customlabels": [],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-
-        stats_uid = "{0}:{1}".format(entry["TYPE"], entry["ID"])
-        perfmetrics_list = [
-                            # "usage",
-                            "queue_length",
-                            "read_iops",
-                            "read_mbytes",
-                            "write_iops",
-                            "write_mbytes",
-                            "max_latency",
-                            # "max_read_latency",
-                            # "max_write_latency",
-                            "avg_read_latency",
-                            "avg_write_latency",
-                            # "avg_cpu_usage",
-                            # "avg_cache_usage",
-                            "read_cache_hits",
-                            "write_cache_hits",
-                            # "read_cache_usage",
-                            # "write_cache_usage",
-                            # "cache_page_usage",
-                            # "cache_chunk_usage",
-                            # "max_read_kbytes",
-                            # "max_write_kbytes",
-                            # "failed_reads",
-                            # "failed_writes",
-
-                            ]
-        data_ids = []
-        for metric in perfmetrics_list:
-            data_ids.append(valuemap("data_ids",metric))
-        data = (connection.get_perf_data(stats_uid,",".join(data_ids)))
-        perf_data = data['data'][0]['CMO_STATISTIC_DATA_LIST'].split(',')
-        for metric in perfmetrics_list:
-            metric_dict = {
-                "key": f"huawei_storage_metrics_{metric}",
-                "value": f"{perf_data.pop(0)}",
-                "customlabels": [],
-                "labels": labels
-            }
-            metrics.append(metric_dict)
-    return metrics
+    def match(self, entry):
+        for field, pattern in self.include:
+            if not pattern.search(field_value(entry, field)):
+                return False
+        for field, pattern in self.exclude:
+            if pattern.search(field_value(entry, field)):
+                return False
+        return True
 
-def get_disk_pool_data(connection):
-    data = connection.get_data("diskpool")
-    metrics = []
-    for entry in data["data"]:
-        labels = [
-                    ("type", "disk_pool"),
-                    ("id", entry["ID"]),
-                    ("name", entry["NAME"]),
-                    ]
-        metric_dict = {
-                            "key": "huawei_storage_component_health_status",
-                            "value": entry["HEALTHSTATUS"],
-                            "customlabels": [("status_text", valuemap("health_status",entry["HEALTHSTATUS"]))],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_component_running_status",
-                            "value": entry["RUNNINGSTATUS"],
-                            "customlabels": [("status_text", valuemap("running_status",entry["RUNNINGSTATUS"]))],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_capacity_total",
-                            "value": entry["TOTALCAPACITY"],
-                            "customlabels": [],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_capacity_allocated",
-                            "value": entry["USEDCAPACITY"],
-                            "customlabels": [],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_remainlife",
-                            "value": entry["remainLife"],
-                            "customlabels": [],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-
-        stats_uid = "{0}:{1}".format(entry["TYPE"], entry["ID"])
-        perfmetrics_list = [
-                            # "usage",
-                            "queue_length",
-                            "read_iops",
-                            "read_mbytes",
-                            "write_iops",
-                            "write_mbytes",
-                            "max_latency",
-                            # "max_read_latency",
-                            # "max_write_latency",
-                            "avg_read_latency",
-                            "avg_write_latency",
-                            # "avg_cpu_usage",
-                            # "avg_cache_usage",
-                            # "read_cache_hits",
-                            # "write_cache_hits",
-                            # "read_cache_usage",
-                            # "write_cache_usage",
-                            # "cache_page_usage",
-                            # "cache_chunk_usage",
-                            # "max_read_kbytes",
-                            # "max_write_kbytes",
-                            # "failed_reads",
-                            # "failed_writes",
-
-                            ]
-        data_ids = []
-        for metric in perfmetrics_list:
-            data_ids.append(valuemap("data_ids",metric))
-        data = (connection.get_perf_data(stats_uid,",".join(data_ids)))
-        perf_data = data['data'][0]['CMO_STATISTIC_DATA_LIST'].split(',')
-        for metric in perfmetrics_list:
-            metric_dict = {
-                "key": f"huawei_storage_metrics_{metric}",
-                "value": f"{perf_data.pop(0)}",
-                "customlabels": [],
-                "labels": labels
-            }
-            metrics.append(metric_dict)
+    def select(self, entries, series):
+        return Selection(self, entries, series)
+
+class Selection(object):
+    """
+    Iterates the entries passing an ObjectFilter, each one worth series samples,
+    and counts the dropped ones.
+    """
+    def __init__(self, object_filter, entries, series) -> None:
+        self.object_filter = object_filter
+        self.entries = entries
+        self.series = series
+        self.filtered = 0
+        self.limited = 0
+
+    def __iter__(self):
+        total = 0
+        max_series = self.object_filter.max_series
+        for entry in self.entries:
+            if not self.object_filter.match(entry):
+                self.filtered += 1
+            elif max_series and total + self.series > max_series:
+                self.limited += 1
+            else:
+                total += self.series
+                yield entry
+
+    def report(self, metrics, typ):
+        metrics.add("huawei_storage_exporter_objects_dropped", self.filtered, (("type", typ), ("reason", "filter")))
+        metrics.add("huawei_storage_exporter_objects_dropped", self.limited, (("type", typ), ("reason", "series_limit")))
+
+def field_value(entry, field):
+    # config keys are lower case, the API uses upper case and a few camel case fields
+    value = entry.get(field.upper())
+    if value is None:
+        value = next((value for key, value in entry.items() if key.lower() == field), "")
+    return f"{value}"
+
+NO_FILTER = ObjectFilter()
+
+STATUS_LABELS = {}
+
+def status_text(typ, id):
+    # all samples with the same status share one label tuple
+    labels = STATUS_LABELS.get((typ, id))
+    if labels is None:
+        labels = STATUS_LABELS.setdefault((typ, id), (("status_text", valuemap(typ, id)),))
+    return labels
+
+def perf_metrics(connection, perf_objects, plan):
+    """
+    Fetch the PerfPlan statistics for all (stats_uid, labels) objects of a module in batches.
+    """
+    metrics = Metrics()
+    if not plan.metrics or not perf_objects:
+        return metrics
+    perf = connection.get_perf_data_batch([stats_uid for stats_uid, labels in perf_objects], plan.data_ids)
+    families = [metrics.setdefault(key, []) for key in plan.families]
+    for stats_uid, labels in perf_objects:
+        if stats_uid not in perf:
+            connection.inventory.forget(stats_uid)
+            continue
+        for samples, value in zip(families, perf[stats_uid]):
+            samples.append(Sample(labels, value))
     return metrics
 
-def get_storage_pool_data(connection):
-    data = connection.get_data("storagepool")
-    metrics = []
-    for entry in data["data"]:
-        labels = [
-                    ("type", "storage_pool"),
-                    ("id", entry["ID"]),
-                    ("name", entry["NAME"]),
-                    ]
-        metric_dict = {
-                            "key": "huawei_storage_component_health_status",
-                            "value": entry["HEALTHSTATUS"],
-                            "customlabels": [("status_text", valuemap("health_status",entry["HEALTHSTATUS"]))],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_component_running_status",
-                            "value": entry["RUNNINGSTATUS"],
-                            "customlabels": [("status_text", valuemap("running_status",entry["RUNNINGSTATUS"]))],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_capacity_total",
-                            "value": entry["USERTOTALCAPACITY"],
-                            "customlabels": [],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_capacity_allocated",
-                            "value": entry["USERWRITEALLOCCAPACITY"],
-                            "customlabels": [],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        stats_uid = "{0}:{1}".format(entry["TYPE"], entry["ID"])
-        perfmetrics_list = [
-                            # "usage",
-                            "queue_length",
-                            "read_iops",
-                            "read_mbytes",
-                            "write_iops",
-                            "write_mbytes",
-                            "max_latency",
-                            # "max_read_latency",
-                            # "max_write_latency",
-                            "avg_read_latency",
-                            "avg_write_latency",
-                            # "avg_cpu_usage",
-                            # "avg_cache_usage",
-                            # "read_cache_hits",
-                            # "write_cache_hits",
-                            # "read_cache_usage",
-                            # "write_cache_usage",
-                            # "cache_page_usage",
-                            # "cache_chunk_usage",
-                            # "max_read_kbytes",
-                            # "max_write_kbytes",
-                            # "failed_reads",
-                            # "failed_writes",
-
-                            ]
-        data_ids = []
-        for metric in perfmetrics_list:
-            data_ids.append(valuemap("data_ids",metric))
-        data = (connection.get_perf_data(stats_uid,",".join(data_ids)))
-        perf_data = data['data'][0]['CMO_STATISTIC_DATA_LIST'].split(',')
-        for metric in perfmetrics_list:
-            metric_dict = {
-                "key": f"huawei_storage_metrics_{metric}",
-                "value": f"{perf_data.pop(0)}",
-                "customlabels": [],
-                "labels": labels
-            }
-            metrics.append(metric_dict)
+class ObjectSpec(object):
+    """
+    Declarative collector of one object type: the list endpoint, the labels and
+    values taken from the fields of each entry and, if a PerfPlan exists for the
+    type, which entries get performance statistics (perf_when = (field, value)).
+    Labels are (label, field) or (label, field, valuemap type), values are
+    (family, field) or (family, field, extra labels).
+    """
+    __slots__ = ('name', 'endpoint', 'type_label', 'labels', 'values', 'perf_when', 'filtered', 'fields')
+
+    def __init__(self, name, endpoint, labels, values=(), perf_when=None, type_label=None, filtered=False) -> None:
+        self.name = name
+        self.endpoint = endpoint
+        self.type_label = ("type", type_label or name)
+        self.labels = tuple((label[0], label[1], VALUEMAP[label[2]] if len(label) > 2 else None) for label in labels)
+        self.values = tuple((value[0], value[1], value[2] if len(value) > 2 else ()) for value in values)
+        self.perf_when = perf_when
+        # objects_dropped is reported even without a configured filter
+        self.filtered = filtered
+        fields = ["ID", "TYPE", "HEALTHSTATUS", "RUNNINGSTATUS"]
+        fields += [label[1] for label in self.labels] + [value[1] for value in self.values]
+        if perf_when:
+            fields.append(perf_when[0])
+        self.fields = tuple(dict.fromkeys(fields))
+
+OBJECT_SPECS = {
+    "get_power_data": ObjectSpec("power", "power", type_label="PSU", labels=(
+        ("serial", "SERIALNUMBER"),
+        ("id", "ID"),
+        ("model", "MODEL"),
+        ("name", "NAME"),
+        ("location", "LOCATION"),
+        )),
+    "get_bbu_data": ObjectSpec("bbu", "backup_power", labels=(
+        ("id", "ID"),
+        ("name", "NAME"),
+        ("location", "LOCATION"),
+        ), values=(
+        ("huawei_storage_remainlife", "REMAINLIFEDAYS"),
+        )),
+    "get_enclosure_data": ObjectSpec("enclosure", "enclosure", labels=(
+        ("serial", "SERIALNUM"),
+        ("id", "ID"),
+        ("name", "NAME"),
+        ("model", "MODEL"),
+        ), values=(
+        ("huawei_storage_component_temperature", "TEMPERATURE"),
+        )),
+    "get_intf_module_data": ObjectSpec("intf_module", "intf_module", labels=(
+        ("id", "ID"),
+        ("name", "NAME"),
+        ("model", "MODEL"),
+        ("location", "LOCATION"),
+        )),
+    "get_fan_data": ObjectSpec("fan", "fan", labels=(
+        ("id", "ID"),
+        ("name", "NAME"),
+        ("location", "LOCATION"),
+        )),
+    "get_disk_data": ObjectSpec("disk", "disk", filtered=True, labels=(
+        ("serial", "SERIALNUMBER"),
+        ("barcode", "barcode"),
+        ("model", "MODEL"),
+        ("location", "LOCATION"),
+        ("id", "ID"),
+        ), values=(
+        ("huawei_storage_component_temperature", "TEMPERATURE"),
+        ("huawei_storage_remainlife", "REMAINLIFE"),
+        ("huawei_storage_usage", "CAPACITYUSAGE"),
+        )),
+    # management ports have no perf statistics, only host ports (LOGICTYPE 0) are queried
+    "get_eth_port_data": ObjectSpec("eth_port", "eth_port", perf_when=("LOGICTYPE", "0"), labels=(
+        ("id", "ID"),
+        ("name", "NAME"),
+        ("mac", "MACADDRESS"),
+        ("ipv4", "IPV4ADDR"),
+        ("v4mask", "IPV4MASK"),
+        ("location", "LOCATION"),
+        ("port_type_id", "LOGICTYPE"),
+        ("port_type_text", "LOGICTYPE", "eth_port_types"),
+        ), values=(
+        ("huawei_storage_port_errors", "crcErrors", (("error_type", "crc"), ("port_type", "eth"))),
+        ("huawei_storage_port_errors", "frameErrors", (("error_type", "frame"), ("port_type", "eth"))),
+        ("huawei_storage_port_errors", "frameLengthErrors", (("error_type", "frame_length"), ("port_type", "eth"))),
+        )),
+    "get_sas_port_data": ObjectSpec("sas_port", "sas_port", labels=(
+        ("id", "ID"),
+        ("name", "NAME"),
+        ("location", "LOCATION"),
+        ), values=(
+        ("huawei_storage_port_errors", "DISPARITYERROR", (("error_type", "disparity"), ("port_type", "sas"))),
+        ("huawei_storage_port_errors", "PHYRESETERRORS", (("error_type", "phy_reset"), ("port_type", "sas"))),
+        )),
+    "get_lun_data": ObjectSpec("lun", "lun", filtered=True, labels=(
+        ("id", "ID"),
+        ("name", "NAME"),
+        ("wwn", "WWN"),
+        ), values=(
+        ("huawei_storage_capacity_total", "CAPACITY"),
+        ("huawei_storage_capacity_allocated", "ALLOCCAPACITY"),
+        )),
+    "get_disk_pool_data": ObjectSpec("disk_pool", "diskpool", labels=(
+        ("id", "ID"),
+        ("name", "NAME"),
+        ), values=(
+        ("huawei_storage_capacity_total", "TOTALCAPACITY"),
+        ("huawei_storage_capacity_allocated", "USEDCAPACITY"),
+        ("huawei_storage_remainlife", "remainLife"),
+        )),
+    "get_storage_pool_data": ObjectSpec("storage_pool", "storagepool", labels=(
+        ("id", "ID"),
+        ("name", "NAME"),
+        ), values=(
+        ("huawei_storage_capacity_total", "USERTOTALCAPACITY"),
+        ("huawei_storage_capacity_allocated", "USERWRITEALLOCCAPACITY"),
+        )),
+    "get_controller_data": ObjectSpec("controller", "controller", labels=(
+        ("id", "ID"),
+        ("name", "NAME"),
+        ("location", "LOCATION"),
+        ), values=(
+        ("huawei_storage_controller_cpuusage", "CPUUSAGE"),
+        ("huawei_storage_controller_memorysize", "MEMORYSIZE"),
+        ("huawei_storage_controller_memoryusage", "MEMORYUSAGE"),
+        )),
+    }
+
+NO_PLAN = PerfPlan([])
+
+def collect_objects(connection, spec):
+    """
+    Run an ObjectSpec: fetch the list, apply the filter of the type, add status,
+    values and perf statistics of every object.
+    """
+    plan = connection.perf_plans.get(spec.name, NO_PLAN)
+    object_filter = connection.filters.get(spec.name, NO_FILTER if spec.filtered else None)
+    fields = spec.fields + object_filter.fields if object_filter is not None else spec.fields
+    data = connection.get_inventory(spec.endpoint, fields)
+    if object_filter is not None:
+        data = object_filter.select(data, 2 + len(spec.values) + len(plan.metrics))
+    metrics = Metrics()
+    # resolve the sample lists once instead of a dict lookup per sample
+    health = metrics.setdefault("huawei_storage_component_health_status", [])
+    running = metrics.setdefault("huawei_storage_component_running_status", [])
+    values = [(metrics.setdefault(family, []), field, extra) for family, field, extra in spec.values]
+    perf_objects = []
+    for entry in data:
+        labels = (spec.type_label,) + tuple((label, mapping[entry[field]] if mapping is not None else entry[field]) for label, field, mapping in spec.labels)
+        health.append(Sample(labels, entry["HEALTHSTATUS"], status_text("health_status", entry["HEALTHSTATUS"])))
+        running.append(Sample(labels, entry["RUNNINGSTATUS"], status_text("running_status", entry["RUNNINGSTATUS"])))
+        for samples, field, extra in values:
+            samples.append(Sample(labels, entry[field], extra))
+        if plan.metrics and (spec.perf_when is None or entry[spec.perf_when[0]] == spec.perf_when[1]):
+            perf_objects.append((f"{entry['TYPE']}:{entry['ID']}", labels))
+    for key in [key for key, samples in metrics.items() if not samples]:
+        del metrics[key]
+    if object_filter is not None:
+        data.report(metrics, spec.name)
+    metrics.extend(perf_metrics(connection, perf_objects, plan))
     return metrics
 
-def get_controller_data(connection):
-    data = connection.get_data("controller")
-    metrics = []
-    for entry in data["data"]:
-        labels = [
-                    ("type", "controller"),
-                    ("id", entry["ID"]),
-                    ("name", entry["NAME"]),
-                    ("location", entry["LOCATION"]),
-                    ]
-        metric_dict = {
-                            "key": "huawei_storage_component_health_status",
-                            "value": entry["HEALTHSTATUS"],
-                            "customlabels": [("status_text", valuemap("health_status",entry["HEALTHSTATUS"]))],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_component_running_status",
-                            "value": entry["RUNNINGSTATUS"],
-                            "customlabels": [("status_text", valuemap("running_status",entry["RUNNINGSTATUS"]))],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_controller_cpuusage",
-                            "value": entry["CPUUSAGE"],
-                            "customlabels": [],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_controller_memorysize",
-                            "value": entry["MEMORYSIZE"],
-                            "customlabels": [],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        metric_dict = {
-                            "key": "huawei_storage_controller_memoryusage",
-                            "value": entry["MEMORYUSAGE"],
-                            "customlabels": [],
-                            "labels": labels
-                            }
-        metrics.append(metric_dict)
-        stats_uid = "{0}:{1}".format(entry["TYPE"], entry["ID"])
-        perfmetrics_list = [
-                            "queue_length",
-                            "read_iops",
-                            "read_mbytes",
-                            "write_iops",
-                            "write_mbytes",
-                            "max_latency",
-                            "avg_read_latency",
-                            "avg_write_latency",
-                            "avg_cpu_usage",
-                            "avg_cache_usage",
-                            "read_cache_hits",
-                            "write_cache_hits",
-                            "read_cache_usage",
-                            "write_cache_usage",
-                            "cache_page_usage",
-                            "cache_chunk_usage",
-                            "max_read_kbytes",
-                            "max_write_kbytes",
-                            # "failed_reads",
-                            # "failed_writes",
-                            # "usage"
-                            ]
-        data_ids = []
-        for metric in perfmetrics_list:
-            data_ids.append(valuemap("data_ids",metric))
-        data = (connection.get_perf_data(stats_uid,",".join(data_ids)))
-        perf_data = data['data'][0]['CMO_STATISTIC_DATA_LIST'].split(',')
-        for metric in perfmetrics_list:
-            metric_dict = {
-                "key": f"huawei_storage_metrics_{metric}",
-                "value": f"{perf_data.pop(0)}",
-                "customlabels": [],
-                "labels": labels
-            }
-            metrics.append(metric_dict)
+def target_settings(conf, target):
+    if not conf or not target in conf:
+        raise KeyError(target)
+    objects = object_specs(conf[target], target)
+    return {
+        'user': conf[target]['user'],
+        'password': conf[target]['password'],
+        'port': conf[target]['port'],
+        'scheme': conf[target].get('scheme', 'https'),
+        'transport': transport(conf[target], target),
+        'modules': modules(conf[target], target, objects),
+        'session_file': session_file(conf[target], target),
+        'perf_batch_size': int(conf[target].get('perf_batch_size', 100)),
+        'concurrency': int(conf[target].get('concurrency', 4)),
+        'module_timeout': float(conf[target].get('module_timeout', 0)),
+        'scrape_timeout': float(conf[target].get('scrape_timeout', 10)),
+        'pool_size': int(conf[target].get('pool_size', conf[target].get('concurrency', 4))),
+        'retries': int(conf[target].get('retries', 2)),
+        'retry_backoff': float(conf[target].get('retry_backoff', 0.2)),
+        'ca_bundle': conf[target].get('ca_bundle'),
+        'page_size': int(conf[target].get('page_size', 100)),
+        'refresh_interval': float(conf[target].get('refresh_interval', 0)),
+        'inventory_ttl': float(conf[target].get('inventory_ttl', 0)),
+        'history': int(conf[target].get('history', 0)),
+        'module_intervals': module_intervals(conf[target], target, objects),
+        'objects': objects,
+        'perf_plans': perf_plans(conf[target], target, objects),
+        'filters': object_filters(conf[target], target, objects),
+        }
+
+def connect(target, settings, timeout):
+    Storage = OceanStor(target, settings['port'], settings['user'], settings['password'], timeout,
+                        perf_batch_size=settings['perf_batch_size'], page_size=settings['page_size'],
+                        inventory_ttl=settings['inventory_ttl'], perf_plans=settings['perf_plans'],
+                        filters=settings['filters'], scheme=settings['scheme'], objects=settings['objects'],
+                        transport=settings['transport'])
+    Storage.configure_pool(settings['pool_size'], settings['retries'], settings['retry_backoff'], settings['ca_bundle'])
+    return Storage
+
+def transport(section, target):
+    value = section.get('transport', 'requests')
+    if not value in ('requests', 'http.client'):
+        raise ValueError(f"{target} transport: {value} is not requests or http.client")
+    return value
+
+def modules(section, target, objects):
+    """
+    The configured modules, a misspelled module raises ValueError when the config is loaded.
+    """
+    names = [module.strip() for module in section['modules'].split(',') if module.strip()]
+    unknown = [module for module in names if not module in objects]
+    if unknown:
+        raise ValueError(f"{target} modules: unknown modules {','.join(unknown)}, possible modules {','.join(objects)}")
+    return names
+
+def module_intervals(section, target, objects):
+    intervals = {}
+    for item in section.get('module_intervals', '').split(','):
+        if item.strip():
+            module, interval = item.split(':')
+            intervals[module.strip()] = float(interval)
+    unknown = [module for module in intervals if not module in objects]
+    if unknown:
+        raise ValueError(f"{target} module_intervals: unknown modules {','.join(unknown)}, possible modules {','.join(objects)}")
+    return intervals
+
+def object_specs(section, target):
+    """
+    OBJECT_SPECS plus the object types configured with object_<type>_endpoint,
+    object_<type>_labels = <label>:<FIELD>,..., object_<type>_values =
+    <family>:<FIELD>,... and object_<type>_perf_when = <FIELD>:<value>.
+    They are collected by the module get_<type>_data.
+    """
+    specs = dict(OBJECT_SPECS)
+    for key, endpoint in section.items():
+        match = re.match(r'^object_(\w+)_endpoint$', key)
+        if not match:
+            continue
+        typ = match.group(1)
+        try:
+            labels = field_pairs(section.get(f"object_{typ}_labels", "id:ID,name:NAME"))
+            values = [(family if family.startswith('huawei_storage_') else f"huawei_storage_{family}", field)
+                      for family, field in field_pairs(section.get(f"object_{typ}_values", ""))]
+            perf_when = field_pairs(section.get(f"object_{typ}_perf_when", ""))
+        except ValueError as err:
+            raise ValueError(f"{target} object_{typ}: {err}")
+        specs[f"get_{typ}_data"] = ObjectSpec(typ, endpoint.strip(), labels, values, perf_when[0] if perf_when else None)
+    return specs
+
+def field_pairs(value):
+    pairs = []
+    for item in value.split(','):
+        if item.strip():
+            name, sep, field = item.partition(':')
+            if not sep or not name.strip() or not field.strip():
+                raise ValueError(f"{item.strip()} is not <name>:<FIELD>")
+            pairs.append((name.strip(), field.strip()))
+    return pairs
+
+def perf_plans(section, target, objects=OBJECT_SPECS):
+    """
+    PERF_PLANS with the object types overridden by perf_metrics_<type> keys.
+    Unknown types or metrics raise ValueError when the config is loaded.
+    """
+    plans = dict(PERF_PLANS)
+    types = list(PERF_PLANS) + [spec.name for module, spec in objects.items() if not module in OBJECT_SPECS]
+    for key, value in section.items():
+        if not key.startswith('perf_metrics_'):
+            continue
+        typ = key[len('perf_metrics_'):]
+        if not typ in types:
+            raise ValueError(f"{target} {key}: unknown object type, possible types {','.join(types)}")
+        metrics = [metric.strip() for metric in value.split(',') if metric.strip()]
+        unknown = [metric for metric in metrics if not metric in DATA_IDS]
+        if unknown:
+            raise ValueError(f"{target} {key}: unknown metrics {','.join(unknown)}, possible metrics {','.join(DATA_IDS)}")
+        plans[typ] = PerfPlan(metrics)
+    return plans
+
+def object_filters(section, target, objects=OBJECT_SPECS):
+    """
+    ObjectFilter per object type from <type>_include_<field> = <regex>,
+    <type>_exclude_<field> = <regex> and <type>_max_series = <n> keys.
+    """
+    types = {spec.name for spec in objects.values()}
+    rules = {}
+    for key, value in section.items():
+        match = re.match(r'^(\w+?)_(include|exclude)_(\w+)$', key) or re.match(r'^(\w+)_(max_series)$', key)
+        if not match or not match.group(1) in types:
+            continue
+        rule = rules.setdefault(match.group(1), {'include': [], 'exclude': [], 'max_series': 0})
+        try:
+            if match.group(2) == 'max_series':
+                rule['max_series'] = int(value)
+            else:
+                rule[match.group(2)].append((match.group(3), re.compile(value)))
+        except (re.error, ValueError) as err:
+            raise ValueError(f"{target} {key}: {err}")
+    return {typ: ObjectFilter(tuple(rule['include']), tuple(rule['exclude']), rule['max_series']) for typ, rule in rules.items()}
+
+def session_file(section, target):
+    if not section.get('session_dir'):
+        return None
+    return os.path.join(section['session_dir'], f"{target}.session")
+
+METRIC_HELP = {
+    "huawei_storage_component_health_status": "Health status of the component, the meaning is in status_text",
+    "huawei_storage_component_running_status": "Running status of the component, the meaning is in status_text",
+    "huawei_storage_component_temperature": "Temperature of the component in degree celsius",
+    "huawei_storage_remainlife": "Remaining life reported by the component",
+    "huawei_storage_usage": "Capacity usage of the disk in percent",
+    "huawei_storage_port_errors": "Error counter of the port by error_type",
+    "huawei_storage_capacity_total": "Total capacity in 512 byte sectors",
+    "huawei_storage_capacity_allocated": "Allocated capacity in 512 byte sectors",
+    "huawei_storage_controller_cpuusage": "CPU usage of the controller in percent",
+    "huawei_storage_controller_memorysize": "Memory size of the controller in MB",
+    "huawei_storage_controller_memoryusage": "Memory usage of the controller in percent",
+    "huawei_storage_exporter_duration": "Duration of the collection in milliseconds",
+    "huawei_storage_up": "1 if the collection of the target succeeded within the timeout",
+    "huawei_storage_module_age_seconds": "Seconds since the module was last fetched successfully",
+    "huawei_storage_module_stale": "1 if the last refresh of the module failed or is overdue",
+    "huawei_storage_exporter_objects_dropped": "Objects skipped by the configured filters or series limit",
+    "huawei_storage_module_up": "1 if the last run of the module succeeded",
+    "huawei_storage_exporter_module_failures_total": "Failed module runs by reason",
+    "huawei_storage_exporter_module_duration_seconds": "Duration of the module runs",
+    "huawei_storage_exporter_request_duration_seconds": "Duration of the REST requests by endpoint",
+    "huawei_storage_exporter_requests_total": "REST requests by endpoint",
+    "huawei_storage_exporter_request_errors_total": "Failed REST requests by endpoint and API error code",
+    "huawei_storage_exporter_response_bytes_total": "Bytes received from the REST API by endpoint",
+    "huawei_storage_exporter_json_parse_seconds_total": "Time spent decoding REST responses by endpoint",
+    "huawei_storage_port_errors_total": "Errors of the port by error_type, monotonic across counter resets of the array",
+    "huawei_storage_port_errors_rate": "Errors per second of the port over the history",
+    "huawei_storage_exporter_worker_up": "1 if the worker process answered the last scrape",
+    "huawei_storage_exporter_worker_restarts_total": "Restarts of the worker process after it exited",
+    }
+
+METRIC_TYPES = {
+    "huawei_storage_exporter_module_duration_seconds": "histogram",
+    "huawei_storage_exporter_request_duration_seconds": "histogram",
+    "huawei_storage_exporter_requests_total": "counter",
+    "huawei_storage_exporter_module_failures_total": "counter",
+    "huawei_storage_exporter_request_errors_total": "counter",
+    "huawei_storage_exporter_response_bytes_total": "counter",
+    "huawei_storage_exporter_json_parse_seconds_total": "counter",
+    "huawei_storage_port_errors_total": "counter",
+    "huawei_storage_exporter_worker_restarts_total": "counter",
+    }
+
+def family_name(key):
+    # histogram samples share the header of their family
+    name, _, suffix = key.rpartition('_')
+    if suffix in ('bucket', 'sum', 'count') and METRIC_TYPES.get(name) == 'histogram':
+        return name
+    return key
+
+def metric_help(family):
+    help_text = METRIC_HELP.get(family)
+    if help_text:
+        return help_text
+    if not family.startswith('huawei_storage_metrics_'):
+        return "Field of a configured object type"
+    metric = family[len('huawei_storage_metrics_'):]
+    name, _, stat = metric.rpartition('_')
+    if stat in History.STATS and name in DATA_IDS:
+        return f"{History.STATS[stat]} of performance statistic {name} over the history"
+    return f"Performance statistic {metric} of the current interval"
+
+def escape(value):
+    return f"{value}".replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render(families, write, chunk_lines=1000):
+    """
+    Write the metric families in Prometheus text format with one HELP/TYPE header
+    per family. Output is passed to write() in chunks of chunk_lines samples.
+    """
+    render_targets({None: families}, write, chunk_lines)
+
+def family_header(family):
+    return f"# HELP {family} {metric_help(family)}\n# TYPE {family} {METRIC_TYPES.get(family, 'gauge')}\n"
+
+def sample_lines(results):
+    """
+    Yield (family, lines) per sample key of {target: families}, the lines of
+    the key on all targets. Samples of named targets get a target label.
+    """
+    # label tuples are shared between samples, format each of them only once
+    formatted = {}
+    def label_text(labels):
+        text = formatted.get(id(labels))
+        if text is None:
+            text = formatted[id(labels)] = ",".join(f'{name}="{escape(value)}"' for name, value in labels)
+        return text
+
+    prefixes = {target: f'target="{escape(target)}"' if target is not None else "" for target in results}
+    keys = {}
+    for families in results.values():
+        keys.update(dict.fromkeys(families))
+    for key in keys:
+        lines = []
+        for target, families in results.items():
+            prefix = prefixes[target]
+            for sample in families.get(key, ()):
+                text = label_text(sample.labels)
+                if sample.extra:
+                    text = f"{text},{label_text(sample.extra)}" if text else label_text(sample.extra)
+                if prefix:
+                    text = f"{prefix},{text}" if text else prefix
+                lines.append(f"{key}{{{text}}} {sample.value}\n")
+        yield family_name(key), lines
+
+def render_targets(results, write, chunk_lines=1000):
+    """
+    Like render() for {target: families} of several arrays. Families present on
+    more than one target share their header and get a target label.
+    """
+    lines = []
+    header = None
+    for family, samples in sample_lines(results):
+        if family != header:
+            header = family
+            lines.append(family_header(family))
+        lines.extend(samples)
+        if len(lines) >= chunk_lines:
+            write("".join(lines))
+            lines = []
+    if lines:
+        write("".join(lines))
+
+def render_blocks(results):
+    """
+    The samples of render_targets() without headers as {family: bytes}, so the
+    blocks of several worker processes can be merged with merge_blocks().
+    """
+    blocks = {}
+    for family, samples in sample_lines(results):
+        blocks.setdefault(family, []).extend(samples)
+    return {family: "".join(samples).encode('utf-8') for family, samples in blocks.items()}
+
+def merge_blocks(parts, write):
+    """
+    Write the render_blocks() of several processes with one header per family.
+    """
+    families = {}
+    for blocks in parts:
+        for family, block in blocks.items():
+            families.setdefault(family, []).append(block)
+    for family, blocks in families.items():
+        write(family_header(family).encode('utf-8'))
+        for block in blocks:
+            write(block)
+
+class Rendered(object):
+    """
+    Rendered exposition of a snapshot, kept between scrapes together with its
+    gzip variant while versions stay the same. The snapshot is compressed once
+    into an unfinished gzip stream, the tail of each scrape is compressed onto
+    a copy of it.
+    """
+    def __init__(self, body, versions=None) -> None:
+        self.body = body
+        self.versions = versions
+        self.compressor = None
+        self.compressed = None
+        self.lock = threading.Lock()
+
+    def gzip(self, tail=b""):
+        with self.lock:
+            if self.compressor is None:
+                compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                self.compressed = compressor.compress(self.body) + compressor.flush(zlib.Z_SYNC_FLUSH)
+                self.compressor = compressor
+            compressor = self.compressor.copy()
+        return self.compressed + compressor.compress(tail) + compressor.flush()
+
+def run_module(Storage, module, timeout=None):
+    """
+    Run one module. With timeout every request of the module has to finish
+    before the module deadline, otherwise the module fails with OceanStorTimeout.
+    """
+    logger.debug(f"fetch metrics for {module}")
+    labels = (("module", module),)
+    stime = time.monotonic()
+    Storage.local.deadline = stime + timeout if timeout else None
+    try:
+        metrics = collect_objects(Storage, Storage.objects[module])
+    except OceanStorTimeout:
+        logger.error(f"module {module} timeout after {time.monotonic() - stime:.1f}s")
+        Storage.stats.set("huawei_storage_module_up", labels, 0)
+        Storage.stats.inc("huawei_storage_exporter_module_failures_total", labels + (("reason", "timeout"),))
+        raise
+    except OceanStorError:
+        logger.error(f"module {module} failed")
+        Storage.stats.set("huawei_storage_module_up", labels, 0)
+        Storage.stats.inc("huawei_storage_exporter_module_failures_total", labels + (("reason", "error"),))
+        raise
+    except Exception as err:
+        logger.exception(f"module {module} failed: {err!r}")
+        Storage.stats.set("huawei_storage_module_up", labels, 0)
+        Storage.stats.inc("huawei_storage_exporter_module_failures_total", labels + (("reason", "error"),))
+        raise OceanStorError(f"module {module} failed: {err!r}") from err
+    finally:
+        Storage.local.deadline = None
+    Storage.stats.observe("huawei_storage_exporter_module_duration_seconds", labels, time.monotonic() - stime)
+    Storage.stats.set("huawei_storage_module_up", labels, 1)
     return metrics
 
+def collect_modules(Storage, modules, concurrency=1, timeout=None):
+    """
+    Run the modules on up to concurrency threads sharing the OceanStor session and
+    return {module: Metrics} of the modules that succeeded within timeout seconds.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    results = {}
+    executor = ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(modules))), thread_name_prefix='module')
+    try:
+        futures = {module: executor.submit(run_module, Storage, module, timeout) for module in modules}
+        for module, future in futures.items():
+            try:
+                results[module] = future.result()
+            except OceanStorError:
+                pass
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    return results
+
+def collect(Storage, modules, concurrency=1, timeout=None):
+    """
+    Collect the modules and return their metrics grouped by family, in configured
+    module order. Failed modules are left out and reported by huawei_storage_module_up,
+    OceanStorError is only raised if all of them failed.
+    """
+    stime = int(time.time() * 1000)
+    results = collect_modules(Storage, modules, concurrency, timeout)
+    if not results:
+        raise OceanStorError("all modules failed")
+    families = Metrics()
+    for module in modules:
+        if module in results:
+            families.extend(results[module])
+    rtime = int(time.time() * 1000) - stime
+    families.add("huawei_storage_exporter_duration", rtime, (("version", f"{__VERSION__}"),))
+    Storage.stats.export(families)
+    return families
+
+class Series(object):
+    """
+    Ring buffer of (time, value) of one series. For counters the values are
+    the running total, which keeps growing when the array resets the counter.
+    """
+    __slots__ = ('values', 'labels', 'extra', 'last', 'total')
+
+    def __init__(self, size) -> None:
+        self.values = deque(maxlen=size)
+        self.labels = None
+        self.extra = None
+        self.last = None
+        self.total = 0
+
+class History(object):
+    """
+    The last size refreshes of the perf statistics and port error counters of
+    one target. Exported as min/max/avg per perf statistic and as a monotonic
+    _total and a _rate per counter. Only background refreshes sample more
+    often than the scrapes.
+    """
+    STATS = {'min': "Minimum", 'max': "Maximum", 'avg': "Average"}
+    COUNTERS = ("huawei_storage_port_errors",)
+
+    def __init__(self, size) -> None:
+        self.size = size
+        # series of the latest result per module, objects gone from the array drop out
+        self.modules = {}
+        self.lock = threading.Lock()
+
+    def update(self, module, now, metrics):
+        # the Series are updated in place, exports from scrape threads wait for the update
+        with self.lock:
+            previous = self.modules.get(module, {})
+            current = {}
+            for key, samples in metrics.items():
+                if not key in self.COUNTERS and not key.startswith('huawei_storage_metrics_'):
+                    continue
+                for sample in samples:
+                    try:
+                        value = float(sample.value)
+                    except (TypeError, ValueError):
+                        continue
+                    ident = (key, sample.labels, sample.extra)
+                    series = previous.get(ident) or Series(self.size)
+                    series.labels = sample.labels
+                    series.extra = sample.extra
+                    if key in self.COUNTERS:
+                        if series.last is None or value < series.last:
+                            # first sample or counter reset on the array
+                            series.total += value
+                        else:
+                            series.total += value - series.last
+                        series.last = value
+                        value = series.total
+                    series.values.append((now, value))
+                    current[ident] = series
+            self.modules[module] = current
+
+    def export(self, metrics):
+        with self.lock:
+            for series_of_module in self.modules.values():
+                for (key, labels, extra), series in series_of_module.items():
+                    values = [value for stime, value in series.values]
+                    if key in self.COUNTERS:
+                        metrics.add(f"{key}_total", number(series.total), series.labels, series.extra)
+                        (ftime, first), (ltime, last) = series.values[0], series.values[-1]
+                        if ltime > ftime:
+                            metrics.add(f"{key}_rate", number(round((last - first) / (ltime - ftime), 6)), series.labels, series.extra)
+                        continue
+                    metrics.add(f"{key}_min", number(min(values)), series.labels, series.extra)
+                    metrics.add(f"{key}_max", number(max(values)), series.labels, series.extra)
+                    metrics.add(f"{key}_avg", number(round(sum(values) / len(values), 6)), series.labels, series.extra)
+
+def number(value):
+    return int(value) if value.is_integer() else value
+
+class Collector(object):
+    """
+    Keeps the latest results of the modules of one target. Each module is only
+    fetched again when its interval (module_intervals, default refresh_interval)
+    has passed. With refresh_interval the collector refreshes in a background
+    thread and scrapes are answered from the latest results; a failed refresh
+    keeps the previous results of the module and marks them stale.
+    """
+    def __init__(self, exporter, target, settings) -> None:
+        self.exporter = exporter
+        self.target = target
+        self.settings = settings
+        self.intervals = {module: settings['module_intervals'].get(module, settings['refresh_interval']) for module in settings['modules']}
+        self.results = {}
+        self.due = {}
+        self.failed = set()
+        self.duration = 0
+        # bumped whenever results change, keys the rendered snapshot
+        self.version = 0
+        # bumped by every refresh, failed ones change the status and self-monitoring
+        self.refreshes = 0
+        self.rendered = {}
+        self.history = History(settings['history']) if settings['history'] else None
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=f"collector {target}", daemon=True)
+
+    def run(self):
+        while not self.stop.is_set():
+            self.refresh()
+            # sleep until the next module is due
+            self.stop.wait(max(0.1, min(self.due.values()) - time.time()))
+
+    def refresh(self):
+        stime = time.time()
+        modules = [module for module in self.settings['modules'] if self.due.get(module, 0) <= stime]
+        if not modules:
+            return
+        self.refreshes += 1
+        try:
+            Storage = self.exporter.storage(self.target, self.settings)
+            results = collect_modules(Storage, modules, self.settings['concurrency'], self.settings['module_timeout'])
+            Storage.persist(self.settings['session_file'])
+        except OceanStorError as err:
+            logger.error(f"{self.target} refresh {err}")
+            results = {}
+        now = time.time()
+        for module in modules:
+            if module in results:
+                self.results[module] = (now, results[module])
+                if self.history is not None:
+                    self.history.update(module, now, results[module])
+                self.failed.discard(module)
+                self.due[module] = stime + self.intervals[module]
+                self.version += 1
+            else:
+                # retry failed modules at the base interval
+                self.failed.add(module)
+                self.due[module] = stime + min(self.intervals[module], self.settings['refresh_interval'])
+        self.duration = int((now - stime) * 1000)
+
+    def snapshot(self):
+        """
+        The module results and their history, unchanged until version changes.
+        """
+        families = Metrics()
+        for module in self.settings['modules']:
+            result = self.results.get(module)
+            if result is not None:
+                families.extend(result[1])
+        if self.history is not None:
+            self.history.export(families)
+        return families
+
+    def status(self):
+        """
+        Age, staleness and self-monitoring, changing with every scrape.
+        """
+        now = time.time()
+        families = Metrics()
+        for module in self.settings['modules']:
+            labels = (("module", module),)
+            result = self.results.get(module)
+            if result is not None:
+                families.add("huawei_storage_module_age_seconds", round(now - result[0], 3), labels)
+            families.add("huawei_storage_module_stale", int(self.stale(module, now)), labels)
+        families.add("huawei_storage_exporter_duration", self.duration, (("version", f"{__VERSION__}"),))
+        Storage = self.exporter.sessions.get(self.target)
+        if Storage is not None:
+            Storage.stats.export(families)
+        return families
+
+    def stale(self, module, now):
+        result = self.results.get(module)
+        # a refresh that hangs longer than two intervals makes the results stale as well
+        interval = self.intervals[module]
+        return module in self.failed or result is None or bool(interval and now - result[0] > 2 * interval)
+
+    def state(self):
+        """
+        Changes whenever anything but the module ages in snapshot() or status() changes.
+        """
+        now = time.time()
+        return (self.version, self.refreshes, tuple(self.stale(module, now) for module in self.settings['modules']))
+
+    def usable(self):
+        """
+        True if there are results and the last refresh did not fail on all modules.
+        """
+        return bool(self.results) and not self.failed >= set(self.settings['modules'])
+
+    def families(self):
+        families = self.snapshot()
+        families.extend(self.status())
+        return families
+
+    def blocks(self, labelled):
+        """
+        (version, render_blocks() of the snapshot), with target label if labelled.
+        Rendered once per version and label variant.
+        """
+        key = self.target if labelled else None
+        cached = self.rendered.get(key)
+        # read the version first, a refresh during rendering only costs a second rendering
+        version = self.version
+        if cached is None or cached[0] != version:
+            cached = self.rendered[key] = (version, render_blocks({key: self.snapshot()}))
+        return cached
+
+class Exporter(object):
+    """
+    Keeps one logged in OceanStor session and one Collector per target between
+    HTTP scrapes. Targets with refresh_interval are collected in the background.
+    """
+    def __init__(self, conf, timeout) -> None:
+        self.conf = conf
+        self.timeout = timeout
+        self.sessions = {}
+        self.locks = {}
+        self.collectors = {}
+        self.rendered = {}
+        self.epoch = f"{os.getpid():x}{int(time.time()):x}"
+        self.lock = threading.Lock()
+
+    def start(self, background=True):
+        for target in self.conf:
+            settings = target_settings(self.conf, target)
+            self.collectors[target] = Collector(self, target, settings)
+            if background and settings['refresh_interval']:
+                self.collectors[target].thread.start()
+
+    def storage(self, target, settings):
+        Storage = self.sessions.get(target)
+        if Storage is None:
+            Storage = connect(target, settings, self.timeout)
+            if settings['session_file']:
+                Storage.load_session(settings['session_file'])
+            self.sessions[target] = Storage
+        if Storage.deviceID is None:
+            Storage.login()
+            Storage.persist(settings['session_file'])
+        return Storage
+
+    def scrape(self, target):
+        return self.refreshed(target).families()
+
+    def refreshed(self, target):
+        """
+        The Collector of target after refreshing the modules that are due.
+        """
+        collector = self.collectors.get(target)
+        if collector is None:
+            settings = target_settings(self.conf, target)
+            with self.lock:
+                collector = self.collectors.setdefault(target, Collector(self, target, settings))
+        if collector.thread.is_alive():
+            # like on demand, a target whose modules all failed is not served
+            if not collector.usable():
+                raise OceanStorError(f"modules failed: {','.join(collector.failed)}" if collector.failed else f"no results of {target} yet")
+            return collector
+        with self.lock:
+            lock = self.locks.setdefault(target, threading.Lock())
+        # a slow or hung array keeps its lock, later scrapes get the last results
+        # or fail after scrape_timeout instead of piling up
+        if not lock.acquire(blocking=False):
+            if collector.usable():
+                return collector
+            if not lock.acquire(timeout=collector.settings['scrape_timeout']):
+                raise OceanStorError(f"collection of {target} still running")
+        try:
+            # only modules whose interval has passed are fetched again
+            collector.refresh()
+            # partial results are served, failed modules show up in huawei_storage_module_up
+            if collector.failed >= set(collector.settings['modules']):
+                raise OceanStorError(f"modules failed: {','.join(collector.failed)}")
+            return collector
+        finally:
+            lock.release()
+
+    def refresh_all(self):
+        """
+        Refresh all configured targets in parallel, each with its own session.
+        Returns {target: Collector or None}. A target still collecting after its
+        scrape_timeout is served with its last results and keeps collecting for
+        the next scrape, None for targets that failed or have no results yet.
+        """
+        from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+        stime = time.monotonic()
+        executor = ThreadPoolExecutor(max_workers=max(1, len(self.conf)), thread_name_prefix='target')
+        futures = {target: executor.submit(self.refreshed, target) for target in self.conf}
+        executor.shutdown(wait=False)
+        collectors = {}
+        for target, future in futures.items():
+            collector = self.collectors.get(target)
+            settings = collector.settings if collector is not None else target_settings(self.conf, target)
+            scrape_timeout = settings['scrape_timeout']
+            try:
+                collectors[target] = future.result(max(0, stime + scrape_timeout - time.monotonic()))
+            except FutureTimeout:
+                collector = self.collectors.get(target)
+                if collector is not None and collector.usable():
+                    logger.warning(f"{target} still collecting after {scrape_timeout}s, serve the last results")
+                    collectors[target] = collector
+                else:
+                    logger.error(f"{target} timeout after {scrape_timeout}s")
+                    collectors[target] = None
+            except Exception:
+                collectors[target] = None
+        return collectors
+
+    def scrape_all(self):
+        """
+        Scrape all configured targets, failed ones are reported with huawei_storage_up 0.
+        """
+        results = {}
+        for target, collector in self.refresh_all().items():
+            results[target] = collector.families() if collector is not None else Metrics()
+            results[target].add("huawei_storage_up", int(collector is not None), ())
+        return results
+
+    def exposition(self, target=None):
+        """
+        Scrape target, all targets if None, and return (Rendered, etag, tail).
+        The Rendered snapshot is reused while no module result changed, tail is
+        the status of the targets rendered for this scrape.
+        """
+        if target is None:
+            collectors = self.refresh_all()
+        else:
+            collectors = {None: self.refreshed(target)}
+        parts = []
+        versions = []
+        states = []
+        status = {}
+        for key, collector in collectors.items():
+            if collector is None:
+                status[key] = Metrics()
+            else:
+                state = collector.state()
+                version, blocks = collector.blocks(key is not None)
+                parts.append(blocks)
+                versions.append((key, version))
+                states.append((key, state))
+                status[key] = collector.status()
+            if target is None:
+                status[key].add("huawei_storage_up", int(collector is not None), ())
+        # failed targets and refreshes change the ETag as well, only the module ages do not
+        # the epoch keeps the versions of a restarted exporter from matching old ETags
+        etag = f'W/"{self.epoch}-{zlib.crc32(repr((target, states)).encode()):08x}"'
+        rendered = self.rendered.get(target)
+        if rendered is None or rendered.versions != versions:
+            body = []
+            merge_blocks(parts, body.append)
+            rendered = self.rendered[target] = Rendered(b"".join(body), versions)
+        tail = []
+        render_targets(status, tail.append)
+        return rendered, etag, "".join(tail).encode('utf-8')
+
+    def close(self):
+        for collector in self.collectors.values():
+            collector.stop.set()
+        for collector in self.collectors.values():
+            if collector.thread.is_alive():
+                collector.thread.join(self.timeout)
+        for target, Storage in self.sessions.items():
+            Storage.close(self.collectors[target].settings['session_file'])
+        self.sessions = {}
+
+def worker_main(args, conf, conn):
+    """
+    Worker process of the Supervisor: an Exporter for the targets of conf.
+    Requests (id, target) are answered out of order with (id, code, message, body),
+    body is the rendered target or the render_blocks() of all targets.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    setup_logging(args)
+    # the supervisor stops the workers, ignore the ctrl-c of the terminal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    exporter = Exporter(conf, args.timeout)
+    exporter.start()
+    lock = threading.Lock()
+
+    def handle(request_id, target):
+        try:
+            if target is None:
+                response = (request_id, 200, None, render_blocks(exporter.scrape_all()))
+            else:
+                lines = []
+                render(exporter.scrape(target), lines.append)
+                response = (request_id, 200, None, "".join(lines).encode('utf-8'))
+        except KeyError:
+            response = (request_id, 404, f"unknown target {target}", None)
+        except OceanStorError as err:
+            response = (request_id, 503, f"{err}", None)
+        except Exception as err:
+            logger.critical(f"{target} {err}")
+            response = (request_id, 500, f"{err}", None)
+        with lock:
+            conn.send(response)
+
+    executor = ThreadPoolExecutor(max_workers=len(conf) + 1, thread_name_prefix='request')
+    try:
+        while True:
+            request = conn.recv()
+            if request is None:
+                break
+            executor.submit(handle, *request)
+    except (EOFError, OSError):
+        # the supervisor is gone
+        pass
+    finally:
+        executor.shutdown(wait=False)
+        exporter.close()
+
+class Worker(object):
+    """
+    One worker process and the pipe to it. HTTP threads wait for their answer
+    on a Future, a reader thread hands the answers over. A worker that exits
+    unexpectedly fails the waiting requests and is started again.
+    """
+    RESTART_DELAY = 1
+
+    def __init__(self, number, args, conf) -> None:
+        self.number = number
+        self.args = args
+        self.conf = conf
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.next_id = 0
+        self.restarts = 0
+        self.process = None
+        self.conn = None
+        self.stopped = False
+
+    def start(self):
+        import multiprocessing
+        # spawn, forking a process with running threads can deadlock
+        context = multiprocessing.get_context('spawn')
+        conn, child = context.Pipe()
+        process = context.Process(target=worker_main, args=(self.args, self.conf, child), name=f"worker {self.number}", daemon=True)
+        process.start()
+        child.close()
+        with self.lock:
+            self.process = process
+            self.conn = conn
+        threading.Thread(target=self.read, args=(conn, process), name=f"worker {self.number} reader", daemon=True).start()
+        logger.info(f"worker {self.number} pid {process.pid} targets {','.join(self.conf)}")
+
+    def read(self, conn, process):
+        while True:
+            try:
+                request_id, code, message, body = conn.recv()
+            except (EOFError, OSError):
+                break
+            with self.lock:
+                future = self.pending.pop(request_id, None)
+            if future is not None:
+                future.set_result((code, message, body))
+        conn.close()
+        process.join()
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_result((503, f"worker {self.number} exited", None))
+        if self.stopped:
+            return
+        logger.error(f"worker {self.number} exited with {process.exitcode}, restart")
+        self.restarts += 1
+        time.sleep(self.RESTART_DELAY)
+        if not self.stopped:
+            self.start()
+
+    def request(self, target, timeout):
+        """
+        Send a request and wait for (code, message, body), OceanStorTimeout after timeout seconds.
+        """
+        from concurrent.futures import Future, TimeoutError as FutureTimeout
+        future = Future()
+        with self.lock:
+            self.next_id += 1
+            request_id = self.next_id
+            self.pending[request_id] = future
+            try:
+                self.conn.send((request_id, target))
+            except (OSError, ValueError) as err:
+                del self.pending[request_id]
+                return (503, f"worker {self.number} {err}", None)
+        try:
+            return future.result(timeout)
+        except FutureTimeout:
+            with self.lock:
+                self.pending.pop(request_id, None)
+            raise OceanStorTimeout(f"worker {self.number} timeout after {timeout}s")
+
+    def stop(self, timeout):
+        self.stopped = True
+        with self.lock:
+            try:
+                self.conn.send(None)
+            except (OSError, ValueError):
+                pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+
+class Supervisor(object):
+    """
+    Spreads the targets round robin over worker processes, so JSON decoding and
+    rendering of many arrays use several cores. Same interface as the Exporter
+    for the MetricsHandler; the workers send rendered bytes back.
+    """
+    def __init__(self, conf, args) -> None:
+        self.conf = conf
+        self.timeout = args.timeout + 5
+        targets = list(conf)
+        shards = [targets[number::args.workers] for number in range(min(args.workers, len(targets)))]
+        self.workers = [Worker(number, args, {target: conf[target] for target in shard}) for number, shard in enumerate(shards)]
+        self.owners = {target: worker for worker in self.workers for target in worker.conf}
+
+    def start(self):
+        # validates the settings of all targets before starting any worker
+        settings = [target_settings(self.conf, target) for target in self.conf]
+        # scrapes inside the workers are limited by scrape_timeout, allow for the transfer
+        self.timeout = max([self.timeout] + [target['scrape_timeout'] + 5 for target in settings])
+        for worker in self.workers:
+            worker.start()
+
+    def exposition(self, target=None):
+        if target is not None:
+            code, message, body = self.owners[target].request(target, self.timeout)
+            if code == 404:
+                raise KeyError(target)
+            if code != 200:
+                raise OceanStorError(message)
+            return Rendered(body), None, b""
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=max(1, len(self.workers)), thread_name_prefix='worker')
+        futures = {worker: executor.submit(worker.request, None, self.timeout) for worker in self.workers}
+        executor.shutdown(wait=False)
+        parts = []
+        failed = Metrics()
+        status = Metrics()
+        for worker, future in futures.items():
+            labels = (("worker", f"{worker.number}"),)
+            try:
+                code, message, body = future.result()
+            except OceanStorError as err:
+                code, message = 503, f"{err}"
+            if code == 200:
+                parts.append(body)
+            else:
+                logger.error(f"worker {worker.number} {message}")
+                for target in worker.conf:
+                    failed.add("huawei_storage_up", 0, (("target", target),))
+            status.add("huawei_storage_exporter_worker_up", int(code == 200), labels)
+            status.add("huawei_storage_exporter_worker_restarts_total", worker.restarts, labels)
+        parts.append(render_blocks({None: failed}))
+        parts.append(render_blocks({None: status}))
+        body = []
+        merge_blocks(parts, body.append)
+        return Rendered(b"".join(body)), None, b""
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop(self.timeout)
+
+def etag_matches(etag, header):
+    """
+    If-None-Match is * or a list of entity tags, compared weakly.
+    """
+    tags = [tag.strip() for tag in header.split(',')]
+    if '*' in tags:
+        return True
+    opaque = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+    return (etag[2:] if etag.startswith('W/') else etag) in opaque
+
+def accepts_gzip(header):
+    """
+    Accept-Encoding lists gzip, or * without gzip, with a qvalue above 0.
+    """
+    qvalues = {}
+    for item in header.split(','):
+        coding, *params = item.split(';')
+        qvalue = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+        qvalues[coding.strip().lower()] = qvalue
+    return qvalues.get('gzip', qvalues.get('*', 0.0)) > 0
+
+class MetricsHandler(object):
+    """
+    /metrics and /probe, mixed into BaseHTTPRequestHandler by serve() so exec
+    mode does not import http.server.
+    """
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path not in ('/metrics', '/probe'):
+            self.send_error(404)
+            return
+        if url.path == '/probe' and not 'target' in query:
+            self.send_error(400, "target parameter missing")
+            return
+        target = query.get('target', [self.server.target])[0]
+        try:
+            rendered, etag, tail = self.server.exporter.exposition(target)
+        except KeyError:
+            logger.error(f"No username / password found for target {target}")
+            self.send_error(404, f"unknown target {target}")
+            return
+        except OceanStorError as err:
+            self.send_error(503, f"{err}")
+            return
+        # weak ETag: nothing but the module ages changed
+        if etag is not None and etag_matches(etag, self.headers.get('If-None-Match', '')):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        gzip = accepts_gzip(self.headers.get('Accept-Encoding', ''))
+        body = [rendered.gzip(tail)] if gzip else [rendered.body, tail]
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', f"{sum(len(part) for part in body)}")
+        self.send_header('Vary', 'Accept-Encoding')
+        if gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        try:
+            for part in body:
+                self.wfile.write(part)
+        except (BrokenPipeError, ConnectionResetError) as err:
+            logger.warning(f"{self.address_string()} {err}")
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+def serve(args, conf):
+    exporter = Supervisor(conf, args) if args.workers else Exporter(conf, args.timeout)
+    # validates the settings of all targets before listening
+    exporter.start()
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    class Handler(MetricsHandler, BaseHTTPRequestHandler):
+        pass
+    server = ThreadingHTTPServer((args.listen_addr, args.listen_port), Handler)
+    server.exporter = exporter
+    server.target = args.target
+    logger.info(f"listen on {args.listen_addr}:{args.listen_port}")
+    # logout from all arrays when the service manager stops us
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        server.exporter.close()
+
+def write_textfile(path, results):
+    """
+    Render results to a temporary file next to path and rename it, so the
+    textfile collector never reads a partly written file.
+    """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            render_targets(results, f.write)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except OSError as err:
+        logger.error(f"write {path} {err}")
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        return False
+    return True
+
+def textfile_loop(exporter, target, path, interval, stop):
+    """
+    Collect target every interval seconds and write its textfile. A collection
+    taking longer than interval skips the missed runs instead of overlapping.
+    """
+    due = time.monotonic()
+    while not stop.is_set():
+        stime = time.monotonic()
+        try:
+            families = exporter.scrape(target)
+            families.add("huawei_storage_up", 1, ())
+        except OceanStorError as err:
+            logger.error(f"{target} {err}")
+            families = Metrics()
+            families.add("huawei_storage_up", 0, ())
+        write_textfile(path, {target: families})
+        now = time.monotonic()
+        due += interval
+        if due < now:
+            logger.warning(f"{target} collection took {now - stime:.1f}s, longer than the interval of {interval}s")
+            while due < now:
+                due += interval
+        stop.wait(due - now)
+
+def textfile(args, conf):
+    """
+    Daemon writing one .prom file per target to args.textfile for the node_exporter
+    textfile collector, each target collected on its own schedule.
+    """
+    if args.target and not args.target in conf:
+        raise KeyError(args.target)
+    exporter = Exporter(conf, args.timeout)
+    # collection happens in textfile_loop, not in background collectors
+    exporter.start(background=False)
+    stop = threading.Event()
+    threads = []
+    for target in ([args.target] if args.target else list(conf)):
+        name = re.sub(r'[^\w.-]', '_', target)
+        path = os.path.join(args.textfile, f"huawei_storage_{name}.prom")
+        interval = exporter.collectors[target].settings['refresh_interval'] or args.interval
+        threads.append(threading.Thread(target=textfile_loop, args=(exporter, target, path, interval, stop), name=f"textfile {target}", daemon=True))
+        logger.info(f"write {path} every {interval}s")
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    for thread in threads:
+        thread.start()
+    try:
+        while not stop.wait(1):
+            pass
+    except KeyboardInterrupt:
+        stop.set()
+    finally:
+        for thread in threads:
+            thread.join(args.timeout)
+        exporter.close()
+
 #
 # --- MAIN ---
 #
 def main(args):
+    conf = {}
     if args.config:
         conf = configargs(args)
-    if not conf or not args.target in conf:
+    try:
+        if args.http:
+            serve(args, conf)
+            return
+        if args.textfile:
+            textfile(args, conf)
+            return
+        settings = target_settings(conf, args.target)
+    except KeyError:
         logger.critical(f"No username / password found for target {args.target}")
         sys.exit(3)
-    else:
-        user = conf[args.target]['user']
-        password = conf[args.target]['password']
-        port = conf[args.target]['port']
-        modules = conf[args.target]['modules'].split(',')
-    stime = int(time.time() * 1000)
-    Storage = OceanStor(args.target,port,user,password, 10)
-    Storage.login()
-
-    for module in  modules:
-        logger.debug(f"fetch metrics for {module}")
-        try:
-            metrics = globals()[module](Storage)
-        except:
-            logger.error(f"mode {module} not found")
-            Storage.logout()
-            sys.exit(3)
-        text_out = "" 
-        for metric in metrics:
-            text_out += metric["key"] + '{'
-            for label in metric["labels"]:
-                text_out += label[0] + '="' + label[1] + '",'
-            for label in metric["customlabels"]:
-                text_out += label[0] + '="' + label[1] + '",'
-            text_out = text_out[:-1] + '} ' + metric["value"] + '\n'
-        print(text_out)
-    rtime = int(time.time() * 1000) - stime
-    print(f'huawei_storage_exporter_duration{{version="{__VERSION__}"}} {rtime}')    
+    except ValueError as err:
+        logger.critical(f"config {err}")
+        sys.exit(3)
+    Storage = connect(args.target, settings, args.timeout)
+    if args.record:
+        Storage.recorder = Recorder(args.record)
+    try:
+        if not settings['session_file'] or not Storage.load_session(settings['session_file']):
+            Storage.login()
+        families = collect(Storage, settings['modules'], settings['concurrency'], settings['module_timeout'])
+        render(families, sys.stdout.write)
+        if Storage.recorder is not None:
+            Storage.recorder.save()
+    except OceanStorError:
+        Storage.close(settings['session_file'])
+        sys.exit(3)
     logger.info(f"fine")
 
-    Storage.logout()
-
-if __name__ == "__main__":
-    args = arguments()
+    Storage.close(settings['session_file'])
 
-    logger = logging.getLogger(__name__)
+def setup_logging(args):
     logger.setLevel(severity(args.verbose))
 
     logformat = logging.Formatter(f"%(asctime)s %(levelname)s\t{args.target}\t%(message)s")
@@ -998,5 +2337,8 @@ if __name__ == "__main__":
     logger.addHandler(streamHandler) 
     requests_log.addHandler(streamHandler)
 
+if __name__ == "__main__":
+    args = arguments()
+    setup_logging(args)
     main(args)
 
@@ -0,0 +1,77 @@
+import os
+import sys
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tools'))
+
+import mock_devicemanager
+import oceanstore_exporter
+
+MODULES = ",".join(oceanstore_exporter.OBJECT_SPECS)
+
+def config(port, **keys):
+    """
+    Config of one target on the mock listening on port, keys override the defaults.
+    """
+    section = {'user': 'user', 'password': 'password', 'port': f"{port}", 'scheme': 'http', 'modules': MODULES}
+    section.update({key: f"{value}" for key, value in keys.items()})
+    return {'127.0.0.1': section}
+
+@pytest.fixture
+def mock():
+    """
+    Start tools/mock_devicemanager.py in a thread, mock(**Array kwargs) returns (array, port).
+    """
+    servers = []
+
+    def start(**kwargs):
+        array = mock_devicemanager.Array(**kwargs)
+        handler = type('Handler', (mock_devicemanager.MockHandler,), {'array': array})
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return array, server.server_port
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+@pytest.fixture
+def exporter():
+    """
+    exporter(conf) returns a started Exporter that is closed after the test.
+    """
+    exporters = []
+
+    def start(conf, timeout=10, background=False):
+        Exporter = oceanstore_exporter.Exporter(conf, timeout)
+        Exporter.start(background)
+        exporters.append(Exporter)
+        return Exporter
+
+    yield start
+    for Exporter in exporters:
+        Exporter.close()
+
+@pytest.fixture
+def storage():
+    """
+    storage(port, **OceanStor kwargs) returns an OceanStor for the mock on port.
+    """
+    sessions = []
+
+    def connect(port, **kwargs):
+        Storage = oceanstore_exporter.OceanStor('127.0.0.1', port, 'user', 'password', 10, scheme='http', **kwargs)
+        sessions.append(Storage)
+        return Storage
+
+    yield connect
+    for Storage in sessions:
+        Storage.logout()
@@ -0,0 +1,74 @@
+"""
+Collection of object types against tools/mock_devicemanager.py.
+"""
+
+import time
+
+import pytest
+
+from conftest import config
+from oceanstore_exporter import OBJECT_SPECS, PERF_PLANS, OceanStorTimeout, collect_objects, run_module, target_settings
+
+def lun_count(metrics):
+    return len(metrics['huawei_storage_component_health_status'])
+
+def test_inventory_cached_until_ttl(mock, storage):
+    array, port = mock(objects={'lun': 20})
+    Storage = storage(port, inventory_ttl=600)
+    assert lun_count(collect_objects(Storage, OBJECT_SPECS['get_lun_data'])) == 20
+    metrics = collect_objects(Storage, OBJECT_SPECS['get_lun_data'])
+    assert lun_count(metrics) == 20
+    assert len(metrics['huawei_storage_metrics_read_iops']) == 20
+    requests = array.stats()['requests']
+    # the second run only queries the perf statistics
+    assert requests['lun'] == 1
+    assert requests['performace_statistic/cur_statistic_data'] == 2
+
+def test_inventory_forgets_deleted_objects(mock, storage):
+    array, port = mock(objects={'lun': 20})
+    Storage = storage(port, inventory_ttl=600)
+    collect_objects(Storage, OBJECT_SPECS['get_lun_data'])
+    array.remove('lun', '5')
+    # the cached list still has the LUN, its perf query fails and the list is due again
+    metrics = collect_objects(Storage, OBJECT_SPECS['get_lun_data'])
+    assert lun_count(metrics) == 20
+    assert len(metrics['huawei_storage_metrics_read_iops']) == 19
+    assert array.stats()['requests']['lun'] == 1
+    metrics = collect_objects(Storage, OBJECT_SPECS['get_lun_data'])
+    assert lun_count(metrics) == 19
+    assert array.stats()['requests']['lun'] == 2
+    assert not '11:5' in Storage.inventory.objects['lun']
+
+def test_filter_and_series_limit(mock, storage):
+    array, port = mock(objects={'lun': 50})
+    settings = target_settings(config(port, lun_exclude_name='_0000[0-4]$', lun_max_series=100), '127.0.0.1')
+    Storage = storage(port, filters=settings['filters'], perf_plans=settings['perf_plans'])
+    metrics = collect_objects(Storage, OBJECT_SPECS['get_lun_data'])
+    # health, running status, two capacities and the perf statistics per LUN
+    per_lun = 4 + len(PERF_PLANS['lun'].metrics)
+    kept = 100 // per_lun
+    names = [dict(sample.labels)['name'] for sample in metrics['huawei_storage_component_health_status']]
+    assert names == [f"lun_{i:05d}" for i in range(5, 5 + kept)]
+    assert sum(len(samples) for key, samples in metrics.items() if key != 'huawei_storage_exporter_objects_dropped') <= 100
+    dropped = {dict(sample.labels)['reason']: sample.value for sample in metrics['huawei_storage_exporter_objects_dropped']}
+    assert dropped == {'filter': 5, 'series_limit': 45 - kept}
+    # perf statistics are only queried for the kept LUNs
+    assert len(metrics['huawei_storage_metrics_read_iops']) == kept
+
+def test_module_deadline(mock, storage):
+    array, port = mock(endpoint_latency={'lun': 1})
+    Storage = storage(port)
+    stime = time.monotonic()
+    with pytest.raises(OceanStorTimeout):
+        run_module(Storage, 'get_lun_data', 0.3)
+    assert time.monotonic() - stime < 1
+    assert Storage.stats.counters[("huawei_storage_exporter_module_failures_total", (("module", "get_lun_data"), ("reason", "timeout")))] == 1
+    # the deadline only applies to the module it was set for
+    assert lun_count(run_module(Storage, 'get_disk_data', 0.3)) > 0
+
+def test_unknown_modules_rejected(mock):
+    array, port = mock()
+    with pytest.raises(ValueError, match="modules: unknown modules get_nope_data"):
+        target_settings(config(port, modules='get_lun_data,get_nope_data'), '127.0.0.1')
+    with pytest.raises(ValueError, match="module_intervals: unknown modules get_nope_data"):
+        target_settings(config(port, modules='get_lun_data', module_intervals='get_nope_data:60'), '127.0.0.1')
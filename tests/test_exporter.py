@@ -0,0 +1,119 @@
+"""
+The resident Exporter and its Collectors against tools/mock_devicemanager.py.
+"""
+
+import socket
+import time
+
+import pytest
+
+from conftest import config
+from oceanstore_exporter import OBJECT_SPECS, History, Metrics, OceanStorError, accepts_gzip, collect_objects, etag_matches
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not reached"
+        time.sleep(0.05)
+
+def test_slow_target_served_with_last_results(mock, exporter):
+    array, port = mock(objects={'lun': 300}, endpoint_latency={'lun': 0.3})
+    Exporter = exporter(config(port, modules='get_lun_data', scrape_timeout=0.5))
+    collector = Exporter.collectors['127.0.0.1']
+    # the first collection takes about a second, nothing to serve yet
+    assert Exporter.refresh_all() == {'127.0.0.1': None}
+    wait_for(lambda: collector.results)
+    stime = time.monotonic()
+    assert Exporter.refresh_all() == {'127.0.0.1': collector}
+    assert time.monotonic() - stime < 1
+    results = Exporter.scrape_all()['127.0.0.1']
+    assert results['huawei_storage_up'][0].value == 1
+    assert len(results['huawei_storage_component_health_status']) == 300
+
+def closed_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def test_background_target_without_results_is_down(exporter):
+    Exporter = exporter(config(closed_port(), modules='get_lun_data', refresh_interval=0.2), timeout=1, background=True)
+    collector = Exporter.collectors['127.0.0.1']
+    wait_for(lambda: collector.failed)
+    with pytest.raises(OceanStorError):
+        Exporter.exposition('127.0.0.1')
+    assert Exporter.scrape_all()['127.0.0.1']['huawei_storage_up'][0].value == 0
+
+def test_background_failed_module_is_stale(mock, exporter):
+    array, port = mock()
+    Exporter = exporter(config(port, modules='get_lun_data,get_disk_data', refresh_interval=0.2), background=True)
+    collector = Exporter.collectors['127.0.0.1']
+    wait_for(lambda: len(collector.results) == 2)
+    array.fail('lun', 1077949002, 1000)
+    wait_for(lambda: 'get_lun_data' in collector.failed)
+    families = Exporter.scrape('127.0.0.1')
+    stale = {dict(sample.labels)['module']: sample.value for sample in families['huawei_storage_module_stale']}
+    assert stale == {'get_lun_data': 1, 'get_disk_data': 0}
+    # the previous results of the failed module are still served
+    assert len([sample for sample in families['huawei_storage_component_health_status'] if ('type', 'lun') in sample.labels]) == 100
+    array.fail('lun', 0, 0)
+    wait_for(lambda: not collector.failed)
+    assert Exporter.exposition('127.0.0.1')[2].count(b'huawei_storage_module_stale{module="get_lun_data"} 0') == 1
+
+def port_samples(families, key, port):
+    return {dict(sample.extra).get('error_type'): sample.value for sample in families.get(key, []) if ('id', port) in sample.labels}
+
+def test_history_of_port_errors(mock, storage):
+    array, port = mock(objects={'eth_port': 3})
+    Storage = storage(port)
+    history = History(5)
+    for now, crc in ((0, "10"), (10, "30"), (20, "5")):
+        array.lists['eth_port'][0]['crcErrors'] = crc
+        history.update('get_eth_port_data', now, collect_objects(Storage, OBJECT_SPECS['get_eth_port_data']))
+    families = Metrics()
+    history.export(families)
+    # the array reset the counter between the last two refreshes, the total keeps counting
+    assert port_samples(families, 'huawei_storage_port_errors_total', '0')['crc'] == 35
+    assert port_samples(families, 'huawei_storage_port_errors_rate', '0')['crc'] == 1.25
+    assert port_samples(families, 'huawei_storage_port_errors_total', '1')['crc'] == 0
+    assert port_samples(families, 'huawei_storage_metrics_read_iops_max', '1')
+    array.remove('eth_port', '1')
+    history.update('get_eth_port_data', 30, collect_objects(Storage, OBJECT_SPECS['get_eth_port_data']))
+    families = Metrics()
+    history.export(families)
+    assert port_samples(families, 'huawei_storage_port_errors_total', '0')['crc'] == 35
+    assert port_samples(families, 'huawei_storage_port_errors_total', '1') == {}
+    assert port_samples(families, 'huawei_storage_metrics_read_iops_max', '1') == {}
+
+def test_etag_changes_on_failed_refresh(mock, exporter):
+    array, port = mock()
+    Exporter = exporter(config(port, modules='get_lun_data,get_disk_data',
+                               module_intervals='get_lun_data:600,get_disk_data:600'))
+    collector = Exporter.collectors['127.0.0.1']
+    etag = Exporter.exposition('127.0.0.1')[1]
+    # nothing due, nothing changed
+    assert Exporter.exposition('127.0.0.1')[1] == etag
+    array.fail('lun', 1077949002, 1000)
+    collector.due = {}
+    failed = Exporter.exposition('127.0.0.1')[1]
+    assert collector.failed == {'get_lun_data'}
+    assert failed != etag
+    # the failed module is due again with every scrape, each failed refresh is a new state
+    assert Exporter.exposition('127.0.0.1')[1] != failed
+    array.fail('lun', 0, 0)
+    recovered = Exporter.exposition('127.0.0.1')[1]
+    assert not collector.failed
+    assert Exporter.exposition('127.0.0.1')[1] == recovered
+
+def test_conditional_and_encoding_headers():
+    assert etag_matches('W/"1-2"', '"1-2"')
+    assert etag_matches('W/"1-2"', 'W/"0-1", W/"1-2"')
+    assert etag_matches('W/"1-2"', '*')
+    assert not etag_matches('W/"1-2"', 'W/"1-23"')
+    assert not etag_matches('W/"1-2"', '')
+    assert accepts_gzip('gzip, deflate')
+    assert accepts_gzip('deflate;q=1.0, GZIP;q=0.5')
+    assert accepts_gzip('*')
+    assert not accepts_gzip('gzip;q=0')
+    assert not accepts_gzip('*;q=1, gzip;q=0')
+    assert not accepts_gzip('identity')
+    assert not accepts_gzip('')
@@ -0,0 +1,114 @@
+"""
+The exporter against tools/mock_devicemanager.py.
+"""
+
+import gzip
+import os
+import subprocess
+import sys
+
+from conftest import MODULES, ROOT
+import pytest
+
+from oceanstore_exporter import PERF_PLANS, OceanStor, OceanStorTimeout, Recorder, Rendered
+
+EXPORTER = os.path.join(ROOT, 'oceanstore_exporter.py')
+BASELINE = os.path.join(ROOT, 'tests', 'baseline.prom')
+
+def samples(text):
+    """
+    Sorted sample lines without the self-monitoring, which changes with every run.
+    """
+    return sorted(line for line in text.splitlines()
+                  if line and not line.startswith(('#', 'huawei_storage_exporter_', 'huawei_storage_module_')))
+
+def run_exec(port, tmp_path, *args):
+    config = tmp_path / 'config.ini'
+    config.write_text(f"[127.0.0.1]\nuser = user\npassword = password\nport = {port}\nscheme = http\nmodules = {MODULES}\n")
+    result = subprocess.run([sys.executable, EXPORTER, '-c', f"{config}", '-t', '127.0.0.1', *args],
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    return result.stdout
+
+def test_pagination(mock, storage):
+    array, port = mock(objects={'lun': 250})
+    Storage = storage(port, page_size=100)
+    entries = list(Storage.get_data('lun'))
+    assert [entry['ID'] for entry in entries] == [f"{i}" for i in range(250)]
+    assert array.stats()['requests']['lun'] == 3
+
+def test_fields_of_every_entry(mock, storage):
+    array, port = mock(objects={'eth_port': 3})
+    del array.lists['eth_port'][0]['IPV4ADDR']
+    entries = list(storage(port).get_data('eth_port', ['ID', 'ipv4addr']))
+    assert entries == [{'ID': '0'}, {'ID': '1', 'IPV4ADDR': '10.0.0.1'}, {'ID': '2', 'IPV4ADDR': '10.0.0.2'}]
+
+def test_perf_batch_error_falls_back_for_the_chunk(mock, storage):
+    array, port = mock(objects={'lun': 300})
+    Storage = storage(port, perf_batch_size=100)
+    stats_uids = [f"11:{i}" for i in range(300)]
+    array.fail(Recorder.PERF_ENDPOINT, 1077949002)
+    assert len(Storage.get_perf_data_batch(stats_uids, PERF_PLANS['lun'].data_ids)) == 300
+    assert array.stats()['requests'][Recorder.PERF_ENDPOINT] == 3 + 100
+    # a busy array does not switch batching off for later scrapes
+    assert Storage.perf_batch_size == 100
+    array.reset()
+    assert len(Storage.get_perf_data_batch(stats_uids, PERF_PLANS['lun'].data_ids)) == 300
+    assert array.stats()['requests'][Recorder.PERF_ENDPOINT] == 3
+
+def test_perf_batch_unsupported(mock, storage):
+    array, port = mock(objects={'lun': 300}, perf_batch=False)
+    Storage = storage(port, perf_batch_size=100)
+    stats_uids = [f"11:{i}" for i in range(300)]
+    perf = Storage.get_perf_data_batch(stats_uids, PERF_PLANS['lun'].data_ids)
+    assert sorted(perf) == sorted(stats_uids)
+    assert Storage.perf_batch_size == 1
+    assert array.stats()['requests'][Recorder.PERF_ENDPOINT] == 1 + 300
+
+def test_relogin_on_expiry(mock, storage):
+    array, port = mock()
+    Storage = storage(port)
+    assert len(list(Storage.get_data('lun'))) == 100
+    array.tokens.clear()
+    assert len(list(Storage.get_data('lun'))) == 100
+    assert array.stats()['requests']['sessions'] == 2
+    assert Storage.stats.counters[("huawei_storage_exporter_request_errors_total", (("endpoint", "lun"), ("code", "-401")))] == 1
+
+@pytest.mark.parametrize('transport', ['requests', 'http.client'])
+def test_read_timeout_is_not_retried(mock, transport):
+    array, port = mock(endpoint_latency={'lun': 1})
+    Storage = OceanStor('127.0.0.1', port, 'user', 'password', 0.3, scheme='http', transport=transport)
+    Storage.configure_pool(1, 2, 0)
+    with pytest.raises(OceanStorTimeout):
+        list(Storage.get_data('lun'))
+    assert Storage.stats.counters[("huawei_storage_exporter_request_errors_total", (("endpoint", "lun"), ("code", "timeout")))] == 1
+    Storage.logout()
+
+def test_exec_matches_baseline(mock, tmp_path):
+    array, port = mock()
+    with open(BASELINE) as f:
+        baseline = f.read().splitlines()
+    assert samples(run_exec(port, tmp_path)) == baseline
+
+def test_record_replay(mock, tmp_path):
+    array, port = mock(objects={'lun': 150})
+    recorded = run_exec(port, tmp_path, '--record', f"{tmp_path / 'recording'}")
+    array, port = mock(replay=f"{tmp_path / 'recording'}")
+    assert samples(run_exec(port, tmp_path)) == samples(recorded)
+
+def test_recorder_without_uuid_in_entries(tmp_path):
+    recorder = Recorder(f"{tmp_path}")
+    params = {'CMO_STATISTIC_UUID': "11:1,11:2", 'CMO_STATISTIC_DATA_ID_LIST': "22,23"}
+    recorder.add(Recorder.PERF_ENDPOINT, params, {'data': [{'CMO_STATISTIC_DATA_LIST': "1,2"}, {'CMO_STATISTIC_DATA_LIST': "3,4"}]})
+    assert recorder.endpoints[Recorder.PERF_ENDPOINT] == {'11:1': {'22': "1", '23': "2"}, '11:2': {'22': "3", '23': "4"}}
+
+def test_rendered_gzip_splices_the_tail():
+    body = b"".join(f'huawei_storage_metrics_read_iops{{id="{i}"}} {i}\n'.encode() for i in range(10000))
+    rendered = Rendered(body)
+    first = rendered.gzip(b"huawei_storage_module_stale 0\n")
+    second = rendered.gzip(b"huawei_storage_module_stale 1\n")
+    assert gzip.decompress(first) == body + b"huawei_storage_module_stale 0\n"
+    assert gzip.decompress(second) == body + b"huawei_storage_module_stale 1\n"
+    # the snapshot is compressed once, both responses start with the same bytes
+    assert first[:len(rendered.compressed)] == second[:len(rendered.compressed)] == rendered.compressed
+    assert gzip.decompress(rendered.gzip()) == body
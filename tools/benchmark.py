@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Benchmark the exporter modules against tools/mock_devicemanager.py: wall time,
+CPU time, REST requests, response bytes and peak Python memory per module and
+for a full scrape including rendering. With --startup the import time and
+whole exec runs per transport are measured instead.
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import oceanstore_exporter
+from oceanstore_exporter import OBJECT_SPECS, collect, connect, render, run_module, target_settings
+
+MOCK = os.path.join(ROOT, 'tools', 'mock_devicemanager.py')
+EXPORTER = os.path.join(ROOT, 'oceanstore_exporter.py')
+
+def arguments():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the Huawei storage exporter against a mock DeviceManager',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--objects", type=str,
+                       default="lun=10000,disk=1000",
+                       help="objects per endpoint of the mock, see mock_devicemanager.py --objects")
+    parser.add_argument("--replay", type=str,
+                       help="replay a directory written by oceanstore_exporter.py --record")
+    parser.add_argument("--latency", type=float,
+                       default=0.0,
+                       help="seconds the mock adds to every response")
+    parser.add_argument("--endpoint_latency", type=str,
+                       default="",
+                       help="seconds the mock adds per endpoint")
+    parser.add_argument("--port", type=int,
+                       default=18088,
+                       help="TCP port of the mock")
+    parser.add_argument("--modules", type=str,
+                       default=",".join(OBJECT_SPECS),
+                       help="modules to benchmark")
+    parser.add_argument("--rounds", type=int,
+                       default=5,
+                       help="measured runs per module, the median is reported")
+    parser.add_argument("--set", type=str, action='append', default=[],
+                       help="exporter config key=value for the target, e.g. --set page_size=500")
+    parser.add_argument("--startup", action="store_true",
+                       help="measure import time and exec runs per transport instead of the modules")
+    parser.add_argument("--json", type=str,
+                       help="also write the results to this file")
+    return parser.parse_args()
+
+def start_mock(args):
+    command = [sys.executable, MOCK, '--listen_port', f"{args.port}", '--objects', args.objects,
+               '--latency', f"{args.latency}", '--endpoint_latency', args.endpoint_latency]
+    if args.replay:
+        command += ['--replay', args.replay]
+    mock = subprocess.Popen(command)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', args.port), timeout=1).close()
+            return mock
+        except OSError:
+            time.sleep(0.1)
+    mock.kill()
+    raise SystemExit(f"mock DeviceManager did not start on port {args.port}")
+
+def mock_call(Storage, method, path):
+    # the mock control endpoints live outside of the device path
+    response = Storage.session.request(method, Storage.url.replace('/deviceManager/rest', path), timeout=10)
+    return response.json()['data']
+
+def measure(Storage, run, rounds):
+    """
+    Median wall and CPU time of rounds runs, REST requests and bytes of the
+    last run and peak traced memory of one extra run.
+    """
+    wall = []
+    cpu = []
+    for i in range(rounds):
+        mock_call(Storage, 'POST', '/mock/reset')
+        stime = time.perf_counter()
+        ctime = time.process_time()
+        result = run()
+        cpu.append(time.process_time() - ctime)
+        wall.append(time.perf_counter() - stime)
+    requests = mock_call(Storage, 'GET', '/mock/stats')
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        'wall_ms': round(statistics.median(wall) * 1000, 1),
+        'cpu_ms': round(statistics.median(cpu) * 1000, 1),
+        'requests': requests['requests_total'],
+        'response_kbytes': round(requests['response_bytes'] / 1024, 1),
+        'peak_kbytes': round(peak / 1024, 1),
+        'samples': sum(len(samples) for samples in result.values()),
+        }
+
+def bench_section(args):
+    section = {'user': 'bench', 'password': 'bench', 'port': f"{args.port}", 'scheme': 'http', 'modules': args.modules}
+    for option in args.set:
+        key, value = option.split('=', 1)
+        section[key.strip()] = value.strip()
+    return section
+
+def benchmark(args):
+    conf = {'bench': bench_section(args)}
+    settings = target_settings(conf, 'bench')
+    Storage = connect('127.0.0.1', settings, 30)
+    Storage.login()
+    results = {}
+    for module in settings['modules']:
+        results[module] = measure(Storage, lambda: run_module(Storage, module), args.rounds)
+
+    def scrape():
+        families = collect(Storage, settings['modules'], settings['concurrency'], settings['module_timeout'])
+        render(families, io.StringIO().write)
+        return families
+    results['scrape'] = measure(Storage, scrape, args.rounds)
+    Storage.logout()
+    return results
+
+def import_time():
+    """
+    Cumulative import time of the exporter module in a fresh interpreter.
+    """
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import oceanstore_exporter'],
+                            cwd=ROOT, capture_output=True, text=True).stderr
+    for line in output.splitlines():
+        fields = [field.strip() for field in line.split('|')]
+        if len(fields) == 3 and fields[2] == 'oceanstore_exporter':
+            return int(fields[1]) / 1000
+    raise SystemExit(f"no import time in {output}")
+
+def startup(args):
+    """
+    Import time and median wall time of whole exec runs against the mock per
+    transport, the cost every scrape pays when started by exporter_exporter.
+    """
+    results = {'import': {'wall_ms': round(statistics.median(import_time() for i in range(args.rounds)), 1)}}
+    with tempfile.TemporaryDirectory() as directory:
+        for transport in ('requests', 'http.client'):
+            path = os.path.join(directory, f"{transport}.ini")
+            section = dict(bench_section(args), transport=transport)
+            with open(path, 'w') as f:
+                f.write("[127.0.0.1]\n" + "".join(f"{key} = {value}\n" for key, value in section.items()))
+            wall = []
+            for i in range(args.rounds):
+                stime = time.perf_counter()
+                subprocess.run([sys.executable, EXPORTER, '-c', path, '-t', '127.0.0.1'], stdout=subprocess.DEVNULL, check=True)
+                wall.append(time.perf_counter() - stime)
+            results[f"exec {transport}"] = {'wall_ms': round(statistics.median(wall) * 1000, 1)}
+    return results
+
+def report(results):
+    columns = [column for column in ('wall_ms', 'cpu_ms', 'requests', 'response_kbytes', 'peak_kbytes', 'samples')
+               if column in next(iter(results.values()))]
+    print(f"{'module':<24}" + "".join(f"{column:>16}" for column in columns))
+    for module, result in results.items():
+        print(f"{module:<24}" + "".join(f"{result[column]:>16}" for column in columns))
+    print(f"max rss {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss} KiB")
+
+if __name__ == "__main__":
+    args = arguments()
+    logging.basicConfig(level='WARNING', format="%(asctime)s %(levelname)s\t%(message)s")
+    oceanstore_exporter.logger.setLevel('WARNING')
+    mock = start_mock(args)
+    try:
+        results = startup(args) if args.startup else benchmark(args)
+    finally:
+        mock.terminate()
+        mock.wait()
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
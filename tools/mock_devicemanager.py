@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+"""
+Mock DeviceManager REST service to run and benchmark the exporter without an
+OceanStor. Replays responses recorded with oceanstore_exporter.py --record or
+synthesizes arrays of any size, with injectable latency.
+"""
+
+import argparse
+import glob
+import json
+import logging
+import os
+import re
+import ssl
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger(__name__)
+
+PERF_ENDPOINT = 'performace_statistic/cur_statistic_data'
+
+# objects per list endpoint of a small array, change with --objects
+OBJECTS = {
+    "power": 4,
+    "backup_power": 4,
+    "enclosure": 2,
+    "intf_module": 8,
+    "fan": 8,
+    "disk": 25,
+    "eth_port": 16,
+    "sas_port": 8,
+    "lun": 100,
+    "diskpool": 1,
+    "storagepool": 2,
+    "controller": 2,
+    }
+
+OBJECT_TYPES = {
+    "power": "23",
+    "backup_power": "3",
+    "enclosure": "206",
+    "intf_module": "209",
+    "fan": "208",
+    "disk": "10",
+    "eth_port": "213",
+    "sas_port": "214",
+    "lun": "11",
+    "diskpool": "266",
+    "storagepool": "216",
+    "controller": "207",
+    }
+
+def arguments():
+    parser = argparse.ArgumentParser(
+        description='Mock Huawei DeviceManager REST service',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("-a", "--listen_addr", type=str,
+                       default="127.0.0.1",
+                       help="TCP address to listen on")
+    parser.add_argument("-p", "--listen_port", type=int,
+                       default=8088,
+                       help="TCP port to listen on")
+    parser.add_argument("--replay", type=str,
+                       help="directory written by oceanstore_exporter.py --record")
+    parser.add_argument("--objects", type=str,
+                       default="",
+                       help="objects per endpoint, e.g. lun=10000,disk=1000. Recorded objects are cloned to reach the count")
+    parser.add_argument("--latency", type=float,
+                       default=0.0,
+                       help="seconds added to every response")
+    parser.add_argument("--endpoint_latency", type=str,
+                       default="",
+                       help="seconds added per endpoint, e.g. lun=0.5,cur_statistic_data=0.2")
+    parser.add_argument("--no_perf_batch", action="store_true",
+                       help="answer only the first UUID of perf queries like firmware without batch support")
+    parser.add_argument("--certfile", type=str,
+                       help="serve HTTPS with this certificate instead of plain HTTP")
+    parser.add_argument("--keyfile", type=str,
+                       help="private key of --certfile")
+    parser.add_argument('--verbose', '-v',
+                       action='store_true',
+                       help='log every request')
+    return parser.parse_args()
+
+def pairs(value, convert):
+    result = {}
+    for item in value.split(','):
+        if item.strip():
+            key, number = item.split('=')
+            result[key.strip()] = convert(number)
+    return result
+
+def synthesize(endpoint, i):
+    """
+    Object number i of a list endpoint with all fields the exporter reads.
+    """
+    return {
+        "ID": f"{i}",
+        "TYPE": OBJECT_TYPES[endpoint],
+        "NAME": f"{endpoint}_{i:05d}",
+        "LOCATION": f"CTE0.{i // 25}.{i % 25}",
+        "HEALTHSTATUS": "1",
+        "RUNNINGSTATUS": "27" if endpoint in ("lun", "diskpool", "storagepool") else "2",
+        "MODEL": f"{endpoint.upper()}-MOCK",
+        "SERIALNUMBER": f"2102{i:08d}",
+        "SERIALNUM": f"2102{i:08d}",
+        "barcode": f"2102{i:08d}",
+        "PARENTID": f"{i % 2}",
+        "TEMPERATURE": f"{30 + i % 10}",
+        "REMAINLIFE": "100",
+        "REMAINLIFEDAYS": "3650",
+        "remainLife": "100",
+        "CAPACITYUSAGE": f"{i % 100}",
+        "MACADDRESS": f"00:18:82:00:{i // 256 % 256:02x}:{i % 256:02x}",
+        "IPV4ADDR": f"10.0.{i // 256 % 256}.{i % 256}",
+        "IPV4MASK": "255.255.255.0",
+        "LOGICTYPE": "2" if i == 0 else "0",
+        "crcErrors": "0",
+        "frameErrors": "0",
+        "frameLengthErrors": "0",
+        "DISPARITYERROR": "0",
+        "PHYRESETERRORS": "0",
+        "WWN": f"6a8ffba100000000{i:016x}",
+        "EXPOSEDTOINITIATOR": "true",
+        "CAPACITY": f"{2097152 * (1 + i % 8)}",
+        "ALLOCCAPACITY": f"{1048576 * (i % 8)}",
+        "TOTALCAPACITY": "1073741824",
+        "USEDCAPACITY": "536870912",
+        "USERTOTALCAPACITY": "1073741824",
+        "USERWRITEALLOCCAPACITY": "536870912",
+        "CPUUSAGE": f"{i % 100}",
+        "MEMORYSIZE": "262144",
+        "MEMORYUSAGE": "60",
+        }
+
+def scale(entries, count):
+    """
+    Clone the entries round robin to count objects. Clones get a unique ID and NAME.
+    """
+    scaled = []
+    for i in range(count):
+        entry = entries[i % len(entries)]
+        copy = i // len(entries)
+        if copy:
+            entry = dict(entry, ID=f"{entry['ID']}{copy:04d}", NAME=f"{entry.get('NAME', '')}_{copy}")
+        scaled.append(entry)
+    return scaled
+
+class Array(object):
+    """
+    Objects, perf data, sessions and request counters of the mocked array.
+    """
+    def __init__(self, replay=None, objects=None, latency=0.0, endpoint_latency=None, perf_batch=True) -> None:
+        self.lists = {}
+        self.perf = {}
+        self.latency = latency
+        self.endpoint_latency = endpoint_latency or {}
+        self.perf_batch = perf_batch
+        self.tokens = set()
+        self.errors = {}
+        self.removed = set()
+        self.lock = threading.Lock()
+        self.reset()
+        if replay:
+            self.load(replay)
+        counts = dict(OBJECTS) if not self.lists else {}
+        counts.update(objects or {})
+        for endpoint, count in counts.items():
+            entries = self.lists.get(endpoint)
+            if entries:
+                self.lists[endpoint] = scale(entries, count)
+            else:
+                self.lists[endpoint] = [synthesize(endpoint, i) for i in range(count)]
+
+    def load(self, directory):
+        for path in glob.glob(os.path.join(directory, '*.json')):
+            name = os.path.basename(path)[:-len('.json')]
+            with open(path) as f:
+                data = json.load(f)['data']
+            if name == PERF_ENDPOINT.replace('/', '_'):
+                self.perf = data
+            elif isinstance(data, list):
+                self.lists[name] = data
+            logger.info(f"replay {name} from {path}")
+
+    def reset(self):
+        with self.lock:
+            self.requests = {}
+            self.bytes = 0
+
+    def count(self, endpoint, size):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.bytes += size
+
+    def stats(self):
+        with self.lock:
+            return {'requests': dict(self.requests), 'requests_total': sum(self.requests.values()),
+                    'response_bytes': self.bytes, 'sessions': len(self.tokens)}
+
+    def remove(self, endpoint, object_id):
+        """
+        Delete an object, perf queries of it fail like on the array.
+        """
+        with self.lock:
+            entries = [entry for entry in self.lists[endpoint] if entry['ID'] == object_id]
+            for entry in entries:
+                self.lists[endpoint].remove(entry)
+                self.removed.add(f"{entry['TYPE']}:{entry['ID']}")
+
+    def fail(self, endpoint, code, times=1):
+        """
+        Answer the next times requests of endpoint with error code.
+        """
+        with self.lock:
+            self.errors[endpoint] = (code, times)
+
+    def error(self, endpoint):
+        with self.lock:
+            code, times = self.errors.get(endpoint, (0, 0))
+            if not times:
+                return 0
+            self.errors[endpoint] = (code, times - 1)
+            return code
+
+    def delay(self, endpoint):
+        delay = self.latency + self.endpoint_latency.get(endpoint.split('/')[-1], 0)
+        if delay:
+            time.sleep(delay)
+
+    def page(self, endpoint, query):
+        entries = self.lists.get(endpoint, [])
+        if 'range' in query:
+            start, end = map(int, re.match(r"\[(\d+)-(\d+)\]", query['range'][0]).groups())
+            entries = entries[start:end]
+        return entries
+
+    def statistics(self, query):
+        data_ids = query['CMO_STATISTIC_DATA_ID_LIST'][0].split(',')
+        data = []
+        stats_uids = query['CMO_STATISTIC_UUID'][0].split(',')
+        if self.removed.intersection(stats_uids):
+            return None
+        for stats_uid in stats_uids if self.perf_batch else stats_uids[:1]:
+            recorded = self.perf.get(stats_uid, {})
+            # values of unknown objects are stable per object and data id
+            values = [recorded.get(data_id) or f"{zlib.crc32(f'{stats_uid}:{data_id}'.encode()) % 1000}" for data_id in data_ids]
+            data.append({'CMO_STATISTIC_UUID': stats_uid, 'CMO_STATISTIC_DATA_LIST': ','.join(values)})
+        return data
+
+class MockHandler(BaseHTTPRequestHandler):
+    """
+    /deviceManager/rest/<deviceid>/<endpoint> like DeviceManager, plus
+    GET /mock/stats for the request counters and POST /mock/reset, /mock/expire
+    and /mock/fail?endpoint=<endpoint>&code=<code>&times=<n>.
+    """
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    array = None
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+    def reply(self, endpoint, data, code=0, description="0"):
+        body = json.dumps({'data': data, 'error': {'code': code, 'description': description, 'suggestion': ""}}).encode()
+        self.array.count(endpoint, len(body))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def endpoint(self):
+        url = urlparse(self.path)
+        match = re.match(r"/deviceManager/rest/[^/]+/(.+)$", url.path)
+        return (match.group(1) if match else url.path), parse_qs(url.query)
+
+    def authorized(self, endpoint):
+        if self.headers.get('iBaseToken') in self.array.tokens:
+            return True
+        self.reply(endpoint, {}, -401, "unauthorized")
+        return False
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        endpoint, query = self.endpoint()
+        if endpoint == '/mock/reset':
+            self.array.reset()
+            return self.reply(endpoint, {})
+        if endpoint == '/mock/expire':
+            self.array.tokens.clear()
+            return self.reply(endpoint, {})
+        if endpoint == '/mock/fail':
+            self.array.fail(query['endpoint'][0], int(query['code'][0]), int(query.get('times', ['1'])[0]))
+            return self.reply(endpoint, {})
+        if endpoint != 'sessions':
+            return self.reply(endpoint, {}, 1077949061, "unsupported")
+        self.array.delay(endpoint)
+        token = os.urandom(16).hex()
+        self.array.tokens.add(token)
+        self.reply(endpoint, {'deviceid': "2102350000000000", 'iBaseToken': token})
+
+    def do_DELETE(self):
+        endpoint, query = self.endpoint()
+        self.array.tokens.discard(self.headers.get('iBaseToken'))
+        self.reply(endpoint, {})
+
+    def do_GET(self):
+        endpoint, query = self.endpoint()
+        if endpoint == '/mock/stats':
+            return self.reply(endpoint, self.array.stats())
+        if not self.authorized(endpoint):
+            return
+        self.array.delay(endpoint)
+        code = self.array.error(endpoint)
+        if code:
+            return self.reply(endpoint, [], code, "injected error")
+        if endpoint == PERF_ENDPOINT:
+            data = self.array.statistics(query)
+            if data is None:
+                return self.reply(endpoint, [], 1077948996, "object does not exist")
+            return self.reply(endpoint, data)
+        if endpoint not in self.array.lists:
+            return self.reply(endpoint, [], 1077949061, f"{endpoint} not found")
+        self.reply(endpoint, self.array.page(endpoint, query))
+
+def serve(args):
+    MockHandler.array = Array(args.replay, pairs(args.objects, int), args.latency, pairs(args.endpoint_latency, float), not args.no_perf_batch)
+    server = ThreadingHTTPServer((args.listen_addr, args.listen_port), MockHandler)
+    server.daemon_threads = True
+    scheme = 'http'
+    if args.certfile:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(args.certfile, args.keyfile)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        scheme = 'https'
+    counts = ','.join(f"{endpoint}={len(entries)}" for endpoint, entries in MockHandler.array.lists.items())
+    logger.info(f"serving {scheme}://{args.listen_addr}:{args.listen_port} {counts}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == "__main__":
+    args = arguments()
+    logging.basicConfig(level='DEBUG' if args.verbose else 'INFO', format="%(asctime)s %(levelname)s\t%(message)s")
+    serve(args)